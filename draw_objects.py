@@ -26,7 +26,7 @@ class DrawObjects(object):
     def __init__(self, topology):
         self.topology = topology
         
-    def __call__(self, image, object_counts, objects, normalized_peaks, pt_lists=None):
+    def __call__(self, image, object_counts, objects, normalized_peaks, pt_lists=None, draw=True):
         topology = self.topology
         height = image.shape[0]
         width = image.shape[1]
@@ -46,11 +46,15 @@ class DrawObjects(object):
                     x = round(xx)
                     yy = float(peak[0]) * height
                     y = round(yy)
-                    cv2.circle(image, (x, y), 3, color, 2)
+                    if draw:
+                        cv2.circle(image, (x, y), 3, color, 2)
                     if pt_lists is not None:
                         pt_lists[i][j * 2 + 2] = xx
                         pt_lists[i][j * 2 + 3] = yy
 
+            if not draw:
+                continue
+
             for k in range(K):
                 color = (255, 255, 255)
                 c_a = topology[k][2]
@@ -64,3 +68,26 @@ class DrawObjects(object):
                     y1 = round(float(peak1[0]) * height)
                     cv2.line(image, (x0, y0), (x1, y1), color, 2)
 
+
+def drawPoses(image, poses, skeleton):
+    '''Draws pose arrays without the trt_pose topology.
+
+    Args:
+        image: BGR image to draw
+        poses: Pose array with shape (objects, parts, 2), normalized to
+            [0, 1], missing keypoints are 0
+        skeleton: List of the 1-based keypoint pairs in the task description
+    '''
+    height = image.shape[0]
+    width = image.shape[1]
+    for pose in poses:
+        valid = [bool(x > 0 or y > 0) for x, y in pose]
+        points = [(round(float(x) * width), round(float(y) * height)) \
+            for x, y in pose]
+        for j in range(len(pose)):
+            if valid[j]:
+                cv2.circle(image, points[j], 3, color_tab[j], 2)
+        for a, b in skeleton:
+            if valid[a - 1] and valid[b - 1]:
+                cv2.line(image, points[a - 1], points[b - 1], \
+                    (255, 255, 255), 2)
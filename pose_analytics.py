@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIT License
+#
+# Copyright (c) 2019, 2020 MACNICA Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+'''Streaming pose analytics.
+
+The pose results of each frame are folded into incremental aggregates with
+vectorised updates, so that live statistics are available at any moment
+without reprocessing the CSV exports.
+
+    Occupancy: Number of the frames and the objects, the current, maximum
+        and exponentially decayed average number of the objects per frame
+    Keypoint counts: Number of the detections of each keypoint
+    Heatmap: Number of the detections of each keypoint in each grid cell
+    Zone poses: Exponentially decayed average pose of the objects whose
+        centroid is in each grid cell
+
+The grid cells are cellSize pixel squares, and the grid grows with the
+observed coordinates. The decay is applied lazily to the updated cells
+only, with the half-life in seconds.
+'''
+
+import json
+import socket
+import threading
+import logging
+import numpy as np
+import pose_stream
+
+
+class PoseAnalyticsError(Exception):
+    pass
+
+
+class PoseAnalytics():
+    '''Incremental per-keypoint aggregates of the pose results.
+    Can be used as a Postprocess publisher.
+
+    Attributes:
+        numParts(int): Number of the keypoints of a pose
+        cellSize(int): Grid cell size in pixel
+        halfLife(float): Half-life of the decayed averages in second
+    '''
+
+    def __init__(self, numParts, cellSize=32, halfLife=60.0):
+        '''
+        Args:
+            numParts(int): Number of the keypoints of a pose
+            cellSize(int): Grid cell size in pixel
+            halfLife(float): Half-life of the decayed averages in second
+        '''
+        self.numParts = numParts
+        self.cellSize = cellSize
+        self.halfLife = halfLife
+        self._lock = threading.Lock()
+        self._server = None
+        self._address = None
+        self.reset()
+
+    def reset(self):
+        '''Clears all aggregates.
+        '''
+        with self._lock:
+            self.numFrames = 0
+            self.numObjects = 0
+            self.currentObjects = 0
+            self.maxObjects = 0
+            self.keypointCounts = np.zeros(self.numParts, dtype=np.int64)
+            self.heatmap = np.zeros((self.numParts, 0, 0), dtype=np.int64)
+            self._zoneSum = np.zeros((0, 0, self.numParts, 2))
+            self._zoneWeight = np.zeros((0, 0, self.numParts))
+            self._zoneTime = np.zeros((0, 0))
+            self._avgObjects = 0.0
+            self._lastTime = None
+
+    def _decay(self, elapsed):
+        return np.power(0.5, np.maximum(elapsed, 0.0) / self.halfLife)
+
+    def _grow(self, rows, cols):
+        height, width = self.heatmap.shape[1:]
+        if rows <= height and cols <= width:
+            return
+        rows = max(rows, height)
+        cols = max(cols, width)
+        pad = ((0, rows - height), (0, cols - width))
+        self.heatmap = np.pad(self.heatmap, ((0, 0),) + pad)
+        self._zoneSum = np.pad(self._zoneSum, pad + ((0, 0), (0, 0)))
+        self._zoneWeight = np.pad(self._zoneWeight, pad + ((0, 0),))
+        self._zoneTime = np.pad(self._zoneTime, pad)
+
+    def publish(self, timestamp, poses):
+        '''Updates the aggregates with the pose results of a frame.
+
+        Args:
+            timestamp(float): Time stamp in seconds since the epoch
+            poses(numpy.ndarray): Pose array with shape (objects, parts, 2),
+                (x, y) pixel coordinates, missing keypoints are 0
+        '''
+        poses = np.asarray(poses, dtype=np.float32)
+        valid = np.any(poses != 0, axis=2)
+        cells = np.maximum(poses // self.cellSize, 0).astype(np.int64)
+        # Centroid of the detected keypoints of each object
+        numValid = np.count_nonzero(valid, axis=1)
+        detected = numValid > 0
+        centroids = np.sum(np.where(valid[..., None], poses, 0), axis=1) \
+            / np.maximum(numValid, 1)[:, None]
+        zones = np.maximum(centroids[detected] // self.cellSize, 0) \
+            .astype(np.int64)
+        with self._lock:
+            numObjects = len(poses)
+            self.numFrames += 1
+            self.numObjects += numObjects
+            self.currentObjects = numObjects
+            self.maxObjects = max(self.maxObjects, numObjects)
+            if self._lastTime is None:
+                self._avgObjects = float(numObjects)
+            else:
+                factor = float(self._decay(timestamp - self._lastTime))
+                self._avgObjects = self._avgObjects * factor \
+                    + numObjects * (1.0 - factor)
+            self._lastTime = timestamp
+            if not np.any(valid):
+                return
+            self.keypointCounts += np.count_nonzero(valid, axis=0)
+            self._grow(int(np.max(cells[..., 1][valid])) + 1, \
+                int(np.max(cells[..., 0][valid])) + 1)
+            parts = np.broadcast_to(np.arange(self.numParts), valid.shape)
+            np.add.at(self.heatmap, (parts[valid], \
+                cells[..., 1][valid], cells[..., 0][valid]), 1)
+            rows, cols = zones[:, 1], zones[:, 0]
+            # Duplicated cells get the same factor assigned once
+            factor = self._decay(timestamp - self._zoneTime[rows, cols])
+            self._zoneSum[rows, cols] *= factor[:, None, None]
+            self._zoneWeight[rows, cols] *= factor[:, None]
+            self._zoneTime[rows, cols] = timestamp
+            objValid = valid[detected]
+            np.add.at(self._zoneSum, (rows, cols), \
+                np.where(objValid[..., None], poses[detected], 0))
+            np.add.at(self._zoneWeight, (rows, cols), objValid)
+
+    def snapshot(self, now=None):
+        '''Returns a copy of the current aggregates.
+
+        Args:
+            now(float): Time to decay the averages to. If None, the time
+                stamp of the last frame.
+
+        Returns:
+            Dict of 'frames', 'objects', 'current_objects', 'max_objects',
+            'average_objects', 'cell_size', 'keypoint_counts' with shape
+            (parts,), 'heatmap' with shape (parts, rows, cols),
+            'zone_weight' with shape (rows, cols, parts) and 'zone_pose' with
+            shape (rows, cols, parts, 2). zone_weight is the decayed number
+            of the detections averaged in zone_pose, zone_pose is 0 where
+            the weight is 0.
+        '''
+        with self._lock:
+            if now is None:
+                now = self._lastTime if self._lastTime is not None else 0.0
+            avgObjects = self._avgObjects
+            if self._lastTime is not None:
+                avgObjects *= float(self._decay(now - self._lastTime))
+            factor = self._decay(now - self._zoneTime)
+            weight = self._zoneWeight * factor[..., None]
+            zoneSum = self._zoneSum * factor[..., None, None]
+            result = {'frames': self.numFrames, \
+                'objects': self.numObjects, \
+                'current_objects': self.currentObjects, \
+                'max_objects': self.maxObjects, \
+                'average_objects': avgObjects, \
+                'cell_size': self.cellSize, \
+                'keypoint_counts': self.keypointCounts.copy(), \
+                'heatmap': self.heatmap.copy()}
+        result['zone_weight'] = weight
+        result['zone_pose'] = zoneSum \
+            / np.where(weight > 0, weight, 1)[..., None]
+        return result
+
+    def serve(self, address):
+        '''Serves the snapshots on a TCP or Unix domain socket.
+        Each line is a command, 'snapshot', 'summary' or 'reset'.
+        The reply is a JSON line, the summary omits the grid arrays.
+
+        Args:
+            address(str): 'HOST:PORT' for TCP, otherwise a Unix socket path
+        '''
+        self._server = pose_stream.listen(address, PoseAnalyticsError)
+        self._address = address
+        threading.Thread(target=self._accept, daemon=True).start()
+        logging.info('Pose analytics listening on %s' % (address))
+
+    def _accept(self):
+        while True:
+            try:
+                conn, peer = self._server.accept()
+            except OSError:
+                break
+            threading.Thread( \
+                target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile('rw') as f:
+            for line in f:
+                command = line.strip()
+                if command == 'reset':
+                    self.reset()
+                    reply = {'ok': True}
+                elif command in ('snapshot', 'summary'):
+                    reply = self.snapshot()
+                    if command == 'summary':
+                        for key in ('heatmap', 'zone_weight', 'zone_pose'):
+                            del reply[key]
+                    reply = dict([(k, v.tolist() \
+                        if isinstance(v, np.ndarray) else v) \
+                        for k, v in reply.items()])
+                else:
+                    reply = {'error': 'invalid command'}
+                try:
+                    f.write(json.dumps(reply) + '\n')
+                    f.flush()
+                except OSError:
+                    break
+
+    def close(self):
+        '''Stops serving the snapshots.
+        '''
+        if self._server is None:
+            return
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        self._server = None
+        pose_stream.unlinkAddress(self._address)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIT License
+#
+# Copyright (c) 2019, 2020 MACNICA Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+'''Speed/accuracy sweep benchmark over recorded video clips.
+
+Every clip is replayed without frame drops through the pose estimation
+pipeline for each configuration of the matrix. The first configuration is
+the reference, and the keypoint error of the other configurations is
+measured against its results on the same frames.
+'''
+
+import sys
+import os
+import gc
+import csv
+import time
+import asyncio
+import itertools
+import argparse
+import logging
+import numpy as np
+import torch
+import pose_capture
+import video_app_utils
+import video_app_async
+import trt_pose_app
+
+
+class PoseRecorder():
+    '''Records the pose results of a run in the output order.
+    '''
+
+    def __init__(self):
+        self.poses = []
+
+    def publish(self, timestamp, poses):
+        self.poses.append(poses)
+
+
+def matchPoses(ref, test):
+    '''Matches the objects of two pose arrays of a frame greedily.
+
+    Args:
+        ref(numpy.ndarray): Reference poses (objects, parts, 2)
+        test(numpy.ndarray): Test poses (objects, parts, 2)
+
+    Returns:
+        (distances, numRef) tuple. distances is the list of the keypoint
+        distances detected in both, numRef is the number of the detected
+        reference keypoints.
+    '''
+    refValid = np.any(ref != 0, axis=2)
+    numRef = int(np.count_nonzero(refValid))
+    if len(ref) == 0 or len(test) == 0:
+        return ([], numRef)
+    testValid = np.any(test != 0, axis=2)
+    # Keypoint distances of all object pairs (ref, test, parts)
+    dist = np.linalg.norm(ref[:, None] - test[None, :], axis=3)
+    valid = refValid[:, None] & testValid[None, :]
+    counts = np.count_nonzero(valid, axis=2)
+    cost = np.where(counts > 0, \
+        np.sum(np.where(valid, dist, 0), axis=2) / np.maximum(counts, 1), \
+        np.inf)
+    distances = []
+    while np.isfinite(cost).any():
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+        distances.extend(dist[i, j][valid[i, j]].tolist())
+        cost[i, :] = np.inf
+        cost[:, j] = np.inf
+    return (distances, numRef)
+
+
+def keypointError(ref, test):
+    '''Compares the results of a run with the reference run of a clip.
+
+    Args:
+        ref(dict): Reference pose arrays by frame index
+        test(dict): Pose arrays by frame index
+
+    Returns:
+        (error, recall) tuple. error is the mean keypoint distance in pixel,
+        recall is the ratio of the reference keypoints also detected.
+    '''
+    distances = []
+    numRef = 0
+    for index in sorted(set(ref.keys()) & set(test.keys())):
+        d, n = matchPoses(ref[index], test[index])
+        distances.extend(d)
+        numRef += n
+    error = float(np.mean(distances)) if distances else float('nan')
+    recall = len(distances) / numRef if numRef > 0 else float('nan')
+    return (error, recall)
+
+
+def runThread(vproc):
+    vproc.startPipeline()
+    while vproc.getOutput() is not None:
+        pass
+    vproc.stopPipeline()
+
+
+def runAsyncio(vproc):
+    async def run():
+        pipeline = video_app_async.AsyncPipeline.fromProcess(vproc)
+        pipeline.start()
+        async for frame in pipeline:
+            stamp = vproc.capture.timestamps.pop(frame)
+            if stamp is not None:
+                vproc.latencies.append(time.time() - stamp)
+        await pipeline.stop()
+    asyncio.run(run())
+    # The worker threads were never started
+    vproc.pipeline = None
+
+
+def runClip(clip, config, appArgs):
+    '''Replays a clip with a configuration.
+
+    Returns:
+        (poses, latencies, elapsed) tuple. poses is a dict of the pose
+        arrays by frame index.
+    '''
+    model, precision, stride, backend = config
+    argv = appArgs + ['--nodrop', '--model', model, \
+        '--precision', precision, '--stride', str(stride), clip]
+    args = trt_pose_app.argumentParser().parse_args(argv)
+    recorder = PoseRecorder()
+    vproc = trt_pose_app.PoseEstimationProcess(args, recorder)
+    vproc.latencies = []
+    startTime = time.time()
+    if backend == 'asyncio':
+        runAsyncio(vproc)
+    else:
+        runThread(vproc)
+    elapsed = time.time() - startTime
+    latencies = vproc.latencies
+    del vproc
+    gc.collect()
+    torch.cuda.empty_cache()
+    # The k-th result is of the (k + 1) * stride-th frame
+    poses = dict([((k + 1) * stride - 1, p) \
+        for k, p in enumerate(recorder.poses)])
+    return (poses, latencies, elapsed)
+
+
+def sweep(clips, configs, appArgs):
+    '''Runs all configurations over all clips.
+
+    Returns:
+        List of the result dicts in the configuration order
+    '''
+    references = {}
+    results = []
+    for config in configs:
+        logging.warning('Configuration: %s' % (str(config)))
+        frames = 0
+        elapsed = 0.0
+        latencies = []
+        errors = []
+        recalls = []
+        for clip in clips:
+            poses, lat, t = runClip(clip, config, appArgs)
+            frames += len(poses)
+            elapsed += t
+            latencies.extend(lat)
+            if clip not in references:
+                references[clip] = poses
+            error, recall = keypointError(references[clip], poses)
+            errors.append(error)
+            recalls.append(recall)
+        if latencies:
+            p50, p90, p99 = np.percentile( \
+                np.array(latencies) * 1000, [50, 90, 99])
+        else:
+            p50 = p90 = p99 = float('nan')
+        model, precision, stride, backend = config
+        fbase = os.path.basename(model)
+        func, width, height = \
+            pose_capture.PoseCaptureModel.getModelFuncName(fbase)
+        results.append({ \
+            'model': fbase, \
+            'input': '%dx%d' % (width, height), \
+            'precision': precision, \
+            'stride': stride, \
+            'backend': backend, \
+            'frames': frames, \
+            'fps': frames / elapsed if elapsed > 0 else 0.0, \
+            'lat_p50_ms': p50, \
+            'lat_p90_ms': p90, \
+            'lat_p99_ms': p99, \
+            'kp_err_px': float(np.nanmean(errors)) \
+                if not np.all(np.isnan(errors)) else float('nan'), \
+            'kp_recall': float(np.nanmean(recalls)) \
+                if not np.all(np.isnan(recalls)) else float('nan')})
+    return results
+
+
+COLUMNS = ['model', 'input', 'precision', 'stride', 'backend', 'frames', \
+    'fps', 'lat_p50_ms', 'lat_p90_ms', 'lat_p99_ms', 'kp_err_px', 'kp_recall']
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return '%.3f' % (value) if abs(value) < 10 else '%.1f' % (value)
+    return str(value)
+
+
+def writeMarkdown(results, f):
+    f.write('| ' + ' | '.join(COLUMNS) + ' |\n')
+    f.write('|' + '---|' * len(COLUMNS) + '\n')
+    for result in results:
+        f.write('| ' + ' | '.join( \
+            [formatValue(result[c]) for c in COLUMNS]) + ' |\n')
+
+
+def writeCsv(results, fname):
+    with open(fname, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser( \
+        description='TRT Pose speed/accuracy sweep benchmark', \
+        epilog='Other arguments are passed to trt_pose_app.py')
+    parser.add_argument('--models', \
+        type=str, \
+        default='resnet18_baseline_att_224x224_A_epoch_249.pth', \
+        metavar='MODELS', \
+        help='Comma separated model weight files')
+    parser.add_argument('--precisions', \
+        type=str, \
+        default='fp16', \
+        metavar='PRECISIONS', \
+        help='Comma separated precisions (fp16, fp32)')
+    parser.add_argument('--strides', \
+        type=str, \
+        default='1', \
+        metavar='STRIDES', \
+        help='Comma separated frame strides')
+    parser.add_argument('--backends', \
+        type=str, \
+        default='thread', \
+        metavar='BACKENDS', \
+        help='Comma separated pipeline runtimes (thread, asyncio)')
+    parser.add_argument('--output', \
+        type=str, \
+        default=None, \
+        metavar='CSV_FILE', \
+        help='If set, also write the results in a CSV file')
+    parser.add_argument('clips', \
+        type=str, \
+        metavar='CLIP', \
+        nargs='+', \
+        help='Recorded video files')
+    args, appArgs = parser.parse_known_args()
+    configs = list(itertools.product( \
+        args.models.split(','), \
+        args.precisions.split(','), \
+        [int(s) for s in args.strides.split(',')], \
+        args.backends.split(',')))
+    try:
+        results = sweep(args.clips, configs, appArgs)
+    except pose_capture.PoseCaptureError as err:
+        print('Application error: %s' % (str(err)))
+        return
+    except video_app_utils.VideoAppUtilsError as err:
+        print('Video application framewrok error: %s' % (str(err)))
+        return
+    writeMarkdown(results, sys.stdout)
+    if args.output is not None:
+        writeCsv(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
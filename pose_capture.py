@@ -34,17 +34,18 @@ import torch
 import torch2trt
 from torch2trt import TRTModule
 import cv2
-import torchvision.transforms as transforms
 from draw_objects import DrawObjects
 from trt_pose.parse_objects import ParseObjects
 import time
 import argparse
 import numpy as np
-import PIL.Image
 import csv
 import datetime
 import re
 import logging
+import threading
+import weakref
+import pose_stream
 
 
 class PoseCaptureError(Exception):
@@ -63,9 +64,22 @@ class PoseCaptureCsvError(PoseCaptureError):
     pass
     
 
+def setNumThreads(numThreads):
+    '''Sets the PyTorch intra-op thread pool size.
+    '''
+    torch.set_num_threads(numThreads)
+
+
+def getNumThreads():
+    '''Returns the PyTorch intra-op thread pool size.
+    '''
+    return torch.get_num_threads()
+
+
 class PoseCaptureModel():
     
-    def __init__(self, modelFile, taskDescFile, csv=0, csvPath='.'):
+    def __init__(self, modelFile, taskDescFile, csv=0, csvPath='.', \
+        fp16=True, maxBatch=1):
         
         # Load the task description
         try:
@@ -90,7 +104,12 @@ class PoseCaptureModel():
             raise PoseCaptureModelError( \
                 'Could not find base model function: %s' % (func))
         func = 'trt_pose.models.' + func
-        trtFile = os.path.splitext(fbase)[0] + '_trt.pth'
+        trtFile = os.path.splitext(fbase)[0]
+        if not fp16:
+            trtFile += '_fp32'
+        if maxBatch > 1:
+            trtFile += '_b%d' % (maxBatch)
+        trtFile += '_trt.pth'
         logging.info('Loading base model from %s' % (func))
         model = eval(func)(num_parts, 2 * num_links).cuda().eval()
         
@@ -103,7 +122,8 @@ class PoseCaptureModel():
             model.load_state_dict(torch.load(modelFile))
             data = torch.zeros((1, 3, self.inHeight, self.inWidth)).cuda()
             model_trt = torch2trt.torch2trt( \
-                model, [data], fp16_mode=True, max_workspace_size=1<<25)
+                model, [data], fp16_mode=fp16, max_workspace_size=1<<25, \
+                max_batch_size=maxBatch)
             torch.save(model_trt.state_dict(), trtFile)
         
         self.mean = torch.Tensor([0.485, 0.456, 0.406]).cuda()
@@ -113,9 +133,16 @@ class PoseCaptureModel():
         self.parse_objects = ParseObjects(topology)
         self.draw_objects = DrawObjects(topology)
         self.model_trt = model_trt
+        self.modelFile = modelFile
+        self.fp16 = fp16
+        self.maxBatch = maxBatch
+        self.keypoints = human_pose['keypoints']
+        self.skeleton = human_pose['skeleton']
         self.num_parts = num_parts
         self.csv = csv
         self.count = 0
+        self.lock = threading.Lock()
+        self.overlay = True
 
         if self.csv > 0:
             try:
@@ -146,6 +173,24 @@ class PoseCaptureModel():
         labels = labels + labels_pt
         self.csvWriter.writerow(labels)
 
+    def inherit(self, other):
+        '''Takes over the CSV recording and the settings from the model
+        to be replaced. The CSV file is shared with the other model until
+        its in-flight frames are processed, and closed by this model.
+
+        Args:
+            other(PoseCaptureModel): Model to be replaced
+        '''
+        with other.lock:
+            self.csv = other.csv
+            self.count = other.count
+            self.overlay = other.overlay
+            if hasattr(other, 'csvFile'):
+                self.csvFile = other.csvFile
+                self.csvWriter = other.csvWriter
+                other.csvFile = None
+            self.lock = other.lock
+
     def _closeCsv(self):
         if hasattr(self, 'csvFile'):
             if self.csvFile is not None:
@@ -153,37 +198,99 @@ class PoseCaptureModel():
                 self.csvFile = None
         
     def preprocess(self, image):
-        image = PIL.Image.fromarray(image)
-        image = transforms.functional.to_tensor(image).to(self.device)
-        image.sub_(self.mean[:, None, None]).div_(self.std[:, None, None])
-        return image[None, ...]
+        return self._normalize(image[None, ...])
+
+    def _normalize(self, images):
+        # The uint8 images are uploaded and converted on the device,
+        # equivalent to the torchvision to_tensor and normalize
+        image = torch.from_numpy(images).to(self.device)
+        image = image.permute(0, 3, 1, 2).float().div_(255.0)
+        image.sub_(self.mean[None, :, None, None]) \
+            .div_(self.std[None, :, None, None])
+        return image.contiguous()
     
     def infer(self, image):
         cmap, paf = self.model_trt(image)
         cmap, paf = cmap.detach().cpu(), paf.detach().cpu()
         return (cmap, paf)
     
-    def postprocess(self, cmap, paf, image):
+    def postprocess(self, cmap, paf, image, listener=None):
+        '''Parses the objects, draws them on the image and records them.
+
+        Args:
+            cmap: Confidence map
+            paf: Part affinity field
+            image: Image to draw the objects
+            listener(callable): If specified, called with the time stamp and
+                the pose array of shape (objects, parts, 2)
+
+        Returns:
+            False if the maximum CSV records reached, otherwise True
+        '''
         counts, objects, peaks = self.parse_objects(cmap, paf)
         pt_lists = \
             [[0] * (self.num_parts * 2 + 2) for i in range(int(counts[0]))]
-        dt = str(datetime.datetime.now())
+        now = datetime.datetime.now()
+        dt = str(now)
         for i in range(int(counts[0])):
             pt_lists[i][0] = dt
             pt_lists[i][1] = i
-        self.draw_objects(image, counts, objects, peaks, pt_lists)
-        if self.csv > 0:
-            self.csvWriter.writerows(pt_lists)
-        self.count += 1
+        self.draw_objects( \
+            image, counts, objects, peaks, pt_lists, self.overlay)
+        if listener is not None:
+            listener(now.timestamp(), self.toPoseArray(pt_lists))
+        # Postprocess may run in parallel replicas
+        with self.lock:
+            if self.csv > 0:
+                self.csvWriter.writerows(pt_lists)
+            self.count += 1
+            count = self.count
         if self.csv <= 0:
             return True
-        elif self.count >= self.csv:
+        elif count >= self.csv:
             logging.info('CSV recored was reached to the max value %d' \
                 % (self.csv))
             return False
         else:
             return True
             
+    def inferPoses(self, images):
+        '''Estimates the poses of a batch of the resized RGB images.
+
+        Args:
+            images(numpy.ndarray): uint8 array with shape
+                (batch, height, width, 3)
+
+        Returns:
+            List of float32 numpy arrays with shape (objects, parts, 2).
+            The coordinates are normalized to [0, 1], missing keypoints
+            are 0.
+        '''
+        cmap, paf = self.infer(self._normalize(images))
+        counts, objects, peaks = self.parse_objects(cmap, paf)
+        results = []
+        for b in range(images.shape[0]):
+            count = int(counts[b])
+            poses = np.zeros((count, self.num_parts, 2), dtype=np.float32)
+            for i in range(count):
+                obj = objects[b][i]
+                for j in range(self.num_parts):
+                    k = int(obj[j])
+                    if k >= 0:
+                        peak = peaks[b][j][k]
+                        poses[i, j] = (float(peak[1]), float(peak[0]))
+            results.append(poses)
+        return results
+
+    def toPoseArray(self, pt_lists):
+        '''Converts the CSV records of a frame to a pose array.
+
+        Returns:
+            float32 numpy array with shape (objects, parts, 2)
+        '''
+        poses = np.array([pt[2:] for pt in pt_lists], dtype=np.float32)
+        return poses.reshape((len(pt_lists), self.num_parts, 2))
+
     def getInputRes(self):
         return (self.inWidth, self.inHeight)
         
@@ -194,3 +301,163 @@ class PoseCaptureModel():
             return (None, None, None)
         else:
             return (result[1], int(result[2]), int(result[3]))
+
+
+class PoseCaptureModelSwitcher():
+    '''Holds the current model and replaces it without stopping the pipeline.
+    A new model is loaded in a background thread while the current model
+    keeps serving, then swapped atomically. The pipeline stages should get
+    the model once per frame with the current method and carry it along
+    with the frame, so that a frame is processed by a single model from
+    the resize to the post-process. The old model is released when its
+    last in-flight frame is done.
+
+    Attributes:
+        taskDescFile: Task description file for the new models
+        models: Model files for the nextModel method
+    '''
+
+    def __init__(self, model, taskDescFile, models=None):
+        '''
+        Args:
+            model(PoseCaptureModel): Initial model
+            taskDescFile(str): Task description file
+            models(list): Model files to cycle through, including the initial
+        '''
+        self.taskDescFile = taskDescFile
+        self.models = models if models is not None else [model.modelFile]
+        self._model = model
+        self._lock = threading.Lock()
+        self._loader = None
+        self._loading = None
+
+    def current(self):
+        '''Returns the current model.
+        '''
+        with self._lock:
+            return self._model
+
+    def busy(self):
+        '''Returns True while a new model is being loaded.
+        '''
+        with self._lock:
+            return self._loader is not None
+
+    def loading(self):
+        '''Returns the model file being loaded, or None.
+        '''
+        with self._lock:
+            return self._loading
+
+    def requestSwap(self, modelFile):
+        '''Starts loading a model in the background and swaps to it.
+
+        Args:
+            modelFile(str): Model weight file
+
+        Returns:
+            False if another model is being loaded
+        '''
+        with self._lock:
+            if self._loader is not None:
+                return False
+            self._loading = modelFile
+            self._loader = threading.Thread( \
+                target=self._load, args=(modelFile,), daemon=True)
+            self._loader.start()
+        return True
+
+    def nextModel(self):
+        '''Swaps to the next model in the models list.
+        '''
+        modelFile = self.current().modelFile
+        if modelFile in self.models:
+            index = (self.models.index(modelFile) + 1) % len(self.models)
+        else:
+            index = 0
+        return self.requestSwap(self.models[index])
+
+    def _load(self, modelFile):
+        logging.warning('Loading model %s in background' % (modelFile))
+        try:
+            current = self.current()
+            model = PoseCaptureModel(modelFile, self.taskDescFile, \
+                fp16=current.fp16, maxBatch=current.maxBatch)
+        except PoseCaptureError as err:
+            logging.error('Could not load model %s: %s' \
+                % (modelFile, str(err)))
+            with self._lock:
+                self._loader = None
+                self._loading = None
+            return
+        with self._lock:
+            old = self._model
+            model.inherit(old)
+            self._model = model
+            self._loader = None
+            self._loading = None
+        logging.warning('Model swapped: %s -> %s' \
+            % (old.modelFile, model.modelFile))
+        # The frames in flight still hold the old model
+        weakref.finalize(old, PoseCaptureModelSwitcher._released, \
+            old.modelFile)
+
+    @staticmethod
+    def _released(modelFile):
+        torch.cuda.empty_cache()
+        logging.warning('Model released: %s' % (modelFile))
+
+    def serveControl(self, address):
+        '''Accepts model swap commands on a TCP or Unix domain socket.
+        Each line is a command, 'swap MODEL', 'next' or 'status'.
+        MODEL is a file in the models list or its index in the list.
+        The reply is a line starting with 'ok' or 'error'.
+
+        Args:
+            address(str): 'HOST:PORT' for TCP, otherwise a Unix socket path
+        '''
+        self._control = pose_stream.listen(address, PoseCaptureError)
+        threading.Thread(target=self._acceptControl, daemon=True).start()
+        logging.info('Model control listening on %s' % (address))
+
+    def _acceptControl(self):
+        while True:
+            try:
+                conn, peer = self._control.accept()
+            except OSError:
+                break
+            threading.Thread( \
+                target=self._serveControl, args=(conn,), daemon=True).start()
+
+    def _listedModel(self, name):
+        if name in self.models:
+            return name
+        if name.isdigit() and int(name) < len(self.models):
+            return self.models[int(name)]
+        return None
+
+    def _serveControl(self, conn):
+        with conn, conn.makefile('rw') as f:
+            for line in f:
+                args = line.split()
+                if len(args) == 2 and args[0] == 'swap':
+                    modelFile = self._listedModel(args[1])
+                    if modelFile is None:
+                        # Only the listed files, a model file is unpickled
+                        f.write('error unknown model\n')
+                        f.flush()
+                        continue
+                    ok = self.requestSwap(modelFile)
+                elif args == ['next']:
+                    ok = self.nextModel()
+                elif args == ['status']:
+                    f.write('ok %s%s\n' % (self.current().modelFile, \
+                        ' loading' if self.busy() else ''))
+                    f.flush()
+                    continue
+                else:
+                    f.write('error invalid command\n')
+                    f.flush()
+                    continue
+                f.write('ok\n' if ok else 'error busy\n')
+                f.flush()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIT License
+#
+# Copyright (c) 2019, 2020 MACNICA Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+'''Remote pose inference service shared by multiple pipeline clients.
+
+On connection, the server sends a hello message, a uint32 length followed
+by a JSON object with the model input size and the task description.
+Then the client sends requests and the server sends the responses in the
+same order on the persistent connection.
+
+    Request:  'PREQ', id(uint64), batch(uint16), height(uint16),
+              width(uint16), uint8 RGB images (batch x height x width x 3)
+    Response: 'PRES', id(uint64), batch(uint16), and a pose_stream message
+              per image with the keypoints normalized to [0, 1]
+
+The requests of all clients are batched dynamically on the server.
+'''
+
+import sys
+import json
+import time
+import queue
+import socket
+import struct
+import threading
+import argparse
+import logging
+import collections
+import numpy as np
+import video_app_utils
+import pose_stream
+from draw_objects import drawPoses
+
+
+class PoseRemoteError(Exception):
+    pass
+
+
+REQUEST = struct.Struct('<4sQHHH')
+RESPONSE = struct.Struct('<4sQH')
+HELLO = struct.Struct('<I')
+
+
+def recvExact(sock, size):
+    buf = pose_stream.recvExact(sock, size)
+    if buf is None:
+        raise PoseRemoteError('Connection closed')
+    return buf
+
+
+def recvPoses(sock):
+    '''Receives a pose_stream message.
+
+    Returns:
+        Pose array with shape (objects, parts, 2)
+    '''
+    try:
+        message = pose_stream.recvMessage(sock)
+    except pose_stream.PoseStreamError:
+        raise PoseRemoteError('Invalid pose message')
+    if message is None:
+        raise PoseRemoteError('Connection closed')
+    return message[2]
+
+
+class RemoteClientSender(pose_stream.PoseStreamSubscriber):
+    '''Sends the responses to a client in its own thread, so that a client
+    not reading the responses never blocks the batch inference. Unlike
+    the pose stream, a response is never dropped, the client is
+    disconnected when its send buffer overflows.
+    '''
+
+    label = 'Client'
+
+    def __init__(self, conn, peer, maxMessages, batchBytes=1 << 20):
+        super().__init__(conn, peer, maxMessages, batchBytes)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _overflow(self):
+        logging.warning('Client %s is not reading, disconnected' \
+            % (str(self.peer)))
+        self._shutdown()
+        return False
+
+
+class PoseInferenceServer():
+    '''Serves a PoseCaptureModel to multiple clients.
+
+    Attributes:
+        model: PoseCaptureModel object
+        maxBatch: Maximum number of the images inferred at once
+        batchTimeout: Maximum time in second to wait for a batch to fill
+        maxPending: Maximum number of the responses buffered per client
+    '''
+
+    def __init__(self, model, address, maxBatch=8, batchTimeout=0.002, \
+        maxPending=16):
+        '''
+        Args:
+            model(PoseCaptureModel): Model to serve
+            address(str): 'HOST:PORT' for TCP, otherwise a Unix socket path
+            maxBatch(int): Maximum batch size, up to the model maxBatch
+            batchTimeout(float): Batch fill timeout in second
+            maxPending(int): Maximum number of the responses buffered per
+                client. A client exceeding it is disconnected.
+        '''
+        self.model = model
+        self.address = address
+        self.maxBatch = max(1, min(maxBatch, model.maxBatch))
+        self.batchTimeout = batchTimeout
+        self.maxPending = maxPending
+        width, height = model.getInputRes()
+        hello = json.dumps({'width': width, 'height': height, \
+            'keypoints': model.keypoints, \
+            'skeleton': model.skeleton}).encode()
+        self.hello = HELLO.pack(len(hello)) + hello
+        self.requests = queue.Queue()
+        self.sock = pose_stream.listen(address, PoseRemoteError)
+
+    def serve(self):
+        '''Accepts the clients and runs the batch inference loop.
+        '''
+        threading.Thread(target=self._accept, daemon=True).start()
+        logging.warning('Pose inference server listening on %s' \
+            % (self.address))
+        while True:
+            self._inferBatch()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, peer = self.sock.accept()
+            except OSError:
+                break
+            if conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._receive, \
+                args=(conn, peer), daemon=True).start()
+
+    def _receive(self, conn, peer):
+        logging.info('Client %s connected' % (str(peer)))
+        # Responses of a connection are sent in the request order
+        sender = RemoteClientSender(conn, peer, self.maxPending)
+        sender.push(self.hello)
+        width, height = self.model.getInputRes()
+        try:
+            while True:
+                magic, reqId, batch, h, w = \
+                    REQUEST.unpack(recvExact(conn, REQUEST.size))
+                if magic != b'PREQ' or (w, h) != (width, height):
+                    raise PoseRemoteError('Invalid request')
+                if batch < 1 or batch > self.maxBatch:
+                    raise PoseRemoteError('Invalid batch size %d' % (batch))
+                images = np.frombuffer(recvExact(conn, batch * h * w * 3), \
+                    dtype=np.uint8).reshape((batch, h, w, 3))
+                self.requests.put((sender, reqId, images))
+        except (OSError, PoseRemoteError) as e:
+            logging.info('Client %s disconnected: %s' % (str(peer), str(e)))
+        sender.close()
+
+    def _inferBatch(self):
+        items = [self.requests.get()]
+        count = len(items[0][2])
+        deadline = time.time() + self.batchTimeout
+        while count < self.maxBatch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            items.append(item)
+            count += len(item[2])
+        images = np.concatenate([item[2] for item in items])
+        results = []
+        for pos in range(0, len(images), self.model.maxBatch):
+            results += self.model.inferPoses( \
+                images[pos:pos + self.model.maxBatch])
+        timestamp = time.time()
+        pos = 0
+        for sender, reqId, reqImages in items:
+            batch = len(reqImages)
+            message = RESPONSE.pack(b'PRES', reqId, batch) + b''.join( \
+                [pose_stream.encode(reqId, timestamp, poses) \
+                for poses in results[pos:pos + batch]])
+            pos += batch
+            sender.push(message)
+
+
+class RemoteInference(video_app_utils.PipelineWorker):
+    '''Inference stage replacement sending the resized frames to
+    a PoseInferenceServer. Up to window requests are kept in flight to hide
+    the network latency, and the outputs are in the input order.
+    The output is (poses, orgFrame, client) tuple. The outputs are put by
+    the receiver thread, so the stage is not supported by the asyncio
+    runtime.
+    '''
+
+    fusible = False
+    synchronous = False
+
+    def __init__(self, qsize, source, client, window=4):
+        '''
+        Args:
+            qsize(int): Output queue capacity
+            source(PipelineWorker): Data source, (frame, orgFrame, ...) tuple
+            client(RemoteInferenceClient): Connected client
+            window(int): Maximum number of the requests in flight
+        '''
+        super().__init__(qsize, source)
+        self.client = client
+        self.window = threading.Semaphore(window)
+        # Requests in flight and the frames skipped by the frame stride
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.reqId = 0
+        self.receiver = None
+
+    def process(self, srcData):
+        frame, orgFrame = srcData[:2]
+        if frame is None:
+            # Skipped by the frame stride, output in the input order
+            with self.lock:
+                if len(self.pending) == 0:
+                    self.put((None, orgFrame, self.client))
+                else:
+                    self.pending.append((None, orgFrame))
+            return (None, None)
+        self.window.acquire()
+        with self.lock:
+            self.pending.append((self.reqId, orgFrame))
+        try:
+            self.client.send(self.reqId, frame[None, ...])
+        except OSError as e:
+            logging.critical(e)
+            return (False, None)
+        self.reqId += 1
+        # The output is put by the receiver thread
+        return (None, None)
+
+    def _receive(self):
+        while True:
+            try:
+                reqId, results = self.client.receive()
+            except (OSError, PoseRemoteError) as e:
+                logging.info('Remote inference: %s' % (str(e)))
+                self._error = True
+                self.put(None)
+                break
+            with self.lock:
+                expected, orgFrame = self.pending.popleft()
+                self.window.release()
+                if reqId != expected:
+                    logging.critical('Unexpected response %d' % (reqId))
+                    self._error = True
+                    self.put(None)
+                    break
+                self.put((results[0], orgFrame, self.client))
+                while len(self.pending) > 0 and self.pending[0][0] is None:
+                    self.put((None, self.pending.popleft()[1], self.client))
+
+    def start(self):
+        self.receiver = threading.Thread(target=self._receive, \
+            name='%s.receive' % (self.stageName()), daemon=True)
+        self.receiver.start()
+        super().start()
+
+    def stop(self):
+        # Unblock the worker thread waiting for the window
+        for i in range(len(self.pending) + 1):
+            self.window.release()
+        super().stop()
+        self.client.close()
+
+
+class RemotePostprocess(video_app_utils.PipelineWorker):
+    '''Post-process stage replacement drawing the remote inference results.
+    '''
+
+    def __init__(self, qsize, source, publishers=()):
+        super().__init__(qsize, source)
+        self.publishers = list(publishers)
+        self.lastPoses = None
+
+    def process(self, srcData):
+        poses, orgFrame, client = srcData
+        if poses is None:
+            # Skipped by the frame stride, the last results are drawn again
+            if self.lastPoses is not None:
+                drawPoses(orgFrame, self.lastPoses, client.skeleton)
+            return (True, orgFrame)
+        self.lastPoses = poses
+        drawPoses(orgFrame, poses, client.skeleton)
+        if len(self.publishers) > 0:
+            height, width = orgFrame.shape[:2]
+            pixels = poses * np.array([width, height], dtype=np.float32)
+            timestamp = time.time()
+            for publisher in self.publishers:
+                publisher.publish(timestamp, pixels)
+        return (True, orgFrame)
+
+
+class RemoteInferenceClient():
+    '''Persistent connection to a PoseInferenceServer.
+
+    Attributes:
+        keypoints: Keypoint names of the served model
+        skeleton: Keypoint pairs of the served model
+    '''
+
+    def __init__(self, address):
+        family, addr = pose_stream.parseAddress(address)
+        try:
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.connect(addr)
+            if family == socket.AF_INET:
+                self.sock.setsockopt( \
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            size, = HELLO.unpack(recvExact(self.sock, HELLO.size))
+            hello = json.loads(recvExact(self.sock, size).decode())
+        except OSError as e:
+            raise PoseRemoteError('Could not connect to %s: %s' \
+                % (address, str(e)))
+        self.width = hello['width']
+        self.height = hello['height']
+        self.keypoints = hello['keypoints']
+        self.skeleton = hello['skeleton']
+        logging.info('Remote model input: %dx%d' % (self.width, self.height))
+
+    def current(self):
+        # Stands in for PoseCaptureModelSwitcher in the Resize stage
+        return self
+
+    def getInputRes(self):
+        return (self.width, self.height)
+
+    def send(self, reqId, images):
+        batch, height, width = images.shape[:3]
+        self.sock.sendall(REQUEST.pack(b'PREQ', reqId, batch, height, width) \
+            + np.ascontiguousarray(images, dtype=np.uint8).tobytes())
+
+    def receive(self):
+        '''Receives a response.
+
+        Returns:
+            (reqId, results) tuple, results is a list of the normalized
+            pose arrays
+        '''
+        magic, reqId, batch = \
+            RESPONSE.unpack(recvExact(self.sock, RESPONSE.size))
+        if magic != b'PRES':
+            raise PoseRemoteError('Invalid response')
+        return (reqId, [recvPoses(self.sock) for i in range(batch)])
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def main():
+    import pose_capture
+    parser = argparse.ArgumentParser(description='TRT Pose Inference Server')
+    parser.add_argument('--model', \
+        type=str, \
+        default='resnet18_baseline_att_224x224_A_epoch_249.pth', \
+        metavar='MODEL', \
+        help='Model weight file')
+    parser.add_argument('--task', \
+        type=str, \
+        default='human_pose.json', \
+        metavar='TASK_DESC', \
+        help='Task description file')
+    parser.add_argument('--precision', \
+        type=str, \
+        default='fp16', \
+        choices=('fp16', 'fp32'), \
+        help='TensorRT inference precision')
+    parser.add_argument('--max-batch', \
+        type=int, \
+        default=8, \
+        metavar='BATCH', \
+        help='Maximum batch size')
+    parser.add_argument('--batch-timeout', \
+        type=float, \
+        default=2.0, \
+        metavar='MSEC', \
+        help='Maximum time to wait for a batch to fill')
+    parser.add_argument('--verbose', \
+        action='store_true', \
+        help='If set, print debug message')
+    parser.add_argument('address', \
+        type=str, \
+        metavar='ADDRESS', \
+        help='HOST:PORT or a Unix socket path to listen on')
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    try:
+        model = pose_capture.PoseCaptureModel(args.model, args.task, \
+            fp16=args.precision == 'fp16', maxBatch=args.max_batch)
+        server = PoseInferenceServer(model, args.address, \
+            args.max_batch, args.batch_timeout / 1000.0)
+        server.serve()
+    except pose_capture.PoseCaptureError as err:
+        print('Application error: %s' % (str(err)))
+    except PoseRemoteError as err:
+        print('Pose remote error: %s' % (str(err)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
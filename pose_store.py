@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIT License
+#
+# Copyright (c) 2019, 2020 MACNICA Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+'''Time-indexed pose result store.
+
+The results of each camera are stored in a directory, partitioned into
+time segments. A segment consists of two append-only files.
+
+    START-LENGTH.idx: Frame index records sorted by the time stamp
+        timestamp(float64), frame(uint64), count(uint16), offset(uint64)
+    START-LENGTH.dat: float32 pose arrays, count x parts x 2 per frame
+
+START and LENGTH are the segment start time in seconds since the epoch and
+the segment length in seconds. Range queries binary search the index of the
+overlapping segments and read only the matching poses from the data file.
+The records are appended in the arrival order, which can be out of the time
+stamp order with parallel post-process replicas or a wall clock step, so
+an index out of order is sorted on read.
+'''
+
+import os
+import re
+import json
+import time
+import threading
+import logging
+import numpy as np
+
+
+class PoseStoreError(Exception):
+    pass
+
+
+INDEX_DTYPE = np.dtype([('timestamp', '<f8'), ('frame', '<u8'), \
+    ('count', '<u2'), ('offset', '<u8')])
+
+SEGMENT_PATTERN = re.compile(r'^(\d+)-(\d+)\.idx$')
+
+
+class PoseStore():
+    '''Pose result store of a camera.
+
+    Attributes:
+        path(str): Directory of the camera
+        numParts(int): Number of the keypoints of a pose
+        segmentLength(int): Length of a new segment in second
+        retention(float): Segments ended before this number of seconds ago
+            are deleted in the background whenever a new segment is started.
+            If None, nothing is deleted.
+    '''
+
+    def __init__(self, root, camera, numParts=None, segmentLength=3600, \
+        flushInterval=1.0, retention=None):
+        '''
+        Args:
+            root(str): Root directory of the store
+            camera(str): Camera name
+            numParts(int): Number of the keypoints. Required if the camera
+                is new to the store.
+            segmentLength(int): Length of a new segment in second
+            flushInterval(float): Maximum time in second before the appended
+                results become visible to the readers
+            retention(float): If specified, compact is called with this
+                retention in a background thread whenever a new segment is
+                started
+        '''
+        self.path = os.path.join(root, camera)
+        metaFile = os.path.join(self.path, 'meta.json')
+        if os.path.exists(metaFile):
+            with open(metaFile, 'r') as f:
+                meta = json.load(f)
+            if numParts is not None and numParts != meta['num_parts']:
+                raise PoseStoreError('Number of parts mismatch: %d != %d' \
+                    % (numParts, meta['num_parts']))
+            numParts = meta['num_parts']
+        elif numParts is None:
+            raise PoseStoreError('Unknown camera: %s' % (camera))
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            with open(metaFile, 'w') as f:
+                json.dump({'num_parts': numParts}, f)
+        self.numParts = numParts
+        self.segmentLength = segmentLength
+        self.flushInterval = flushInterval
+        self.retention = retention
+        self._lock = threading.Lock()
+        # Serializes the segment file replacement with the readers
+        self._filesLock = threading.Lock()
+        self._compactLock = threading.Lock()
+        self._compactThread = None
+        self._segment = None
+        self._idxFile = None
+        self._datFile = None
+        self._offset = 0
+        self._frame = 0
+        self._lastFlush = 0.0
+
+    def __del__(self):
+        self.close()
+
+    @staticmethod
+    def cameras(root):
+        '''Returns the camera names in the store.
+        '''
+        if not os.path.isdir(root):
+            return []
+        return sorted([d for d in os.listdir(root) \
+            if os.path.exists(os.path.join(root, d, 'meta.json'))])
+
+    def segments(self):
+        '''Returns the (start, length) tuples of the segments sorted by
+        the start time.
+        '''
+        segments = []
+        for fname in os.listdir(self.path):
+            result = SEGMENT_PATTERN.match(fname)
+            if result is not None:
+                segments.append((int(result[1]), int(result[2])))
+        return sorted(segments)
+
+    def _segmentPath(self, segment, ext):
+        return os.path.join(self.path, '%d-%d%s' % (segment + (ext,)))
+
+    def _open(self, timestamp):
+        self._close()
+        start = int(timestamp // self.segmentLength) * self.segmentLength
+        self._segment = (start, self.segmentLength)
+        self._idxFile = open(self._segmentPath(self._segment, '.idx'), 'ab')
+        self._datFile = open(self._segmentPath(self._segment, '.dat'), 'ab')
+        # Discard the partially written data of an interrupted writer
+        index = self._readIndex(self._segment)
+        self._offset = 0
+        if len(index) > 0:
+            self._offset = int(index['offset'][-1]) + int(index['count'][-1])
+            self._frame = max(self._frame, int(index['frame'][-1]) + 1)
+        self._idxFile.truncate(len(index) * INDEX_DTYPE.itemsize)
+        self._datFile.truncate(self._offset * self.numParts * 2 * 4)
+        logging.info('Pose store segment: %s' \
+            % (self._segmentPath(self._segment, '')))
+
+    def _close(self):
+        if self._idxFile is not None:
+            self._datFile.close()
+            self._idxFile.close()
+            self._idxFile = None
+            self._datFile = None
+            self._segment = None
+
+    def close(self):
+        '''Flushes and closes the current segment. Waits for the background
+        compaction if running.
+        '''
+        if hasattr(self, '_lock'):
+            with self._lock:
+                self._close()
+                thread = self._compactThread
+                self._compactThread = None
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+
+    def append(self, timestamp, poses):
+        '''Appends the pose results of a frame.
+
+        Args:
+            timestamp(float): Time stamp in seconds since the epoch
+            poses(numpy.ndarray): Pose array with shape (objects, parts, 2)
+        '''
+        poses = np.ascontiguousarray(poses, dtype='<f4')
+        with self._lock:
+            if self._segment is None or timestamp < self._segment[0] \
+                or timestamp >= self._segment[0] + self._segment[1]:
+                rollover = self._segment is not None \
+                    and timestamp >= self._segment[0] + self._segment[1]
+                self._open(timestamp)
+                if rollover and self.retention is not None:
+                    self._startCompaction(timestamp)
+            record = np.array([(timestamp, self._frame, len(poses), \
+                self._offset)], dtype=INDEX_DTYPE)
+            # The data is written first, the readers trust the index
+            self._datFile.write(poses.tobytes())
+            self._idxFile.write(record.tobytes())
+            self._offset += len(poses)
+            self._frame += 1
+            if timestamp - self._lastFlush >= self.flushInterval:
+                self._datFile.flush()
+                self._idxFile.flush()
+                self._lastFlush = timestamp
+
+    # The store can be used as a Postprocess publisher
+    publish = append
+
+    def _startCompaction(self, now):
+        # Called with the lock held, keeps the publisher thread unblocked
+        if self._compactThread is not None and self._compactThread.is_alive():
+            return
+        self._compactThread = threading.Thread(target=self.compact, \
+            args=(self.retention, 86400, 86400, now), daemon=True)
+        self._compactThread.start()
+
+    def _readIndex(self, segment):
+        with open(self._segmentPath(segment, '.idx'), 'rb') as f:
+            buf = f.read()
+        # Ignore a partially written record
+        size = len(buf) - len(buf) % INDEX_DTYPE.itemsize
+        return np.frombuffer(buf[:size], dtype=INDEX_DTYPE)
+
+    def _readPoses(self, segment, begin, end):
+        if end <= begin:
+            return np.zeros((0, self.numParts, 2), dtype=np.float32)
+        data = np.memmap(self._segmentPath(segment, '.dat'), dtype='<f4', \
+            mode='r', shape=(end, self.numParts, 2))
+        return np.array(data[begin:end])
+
+    def query(self, start, end, objectId=None):
+        '''Returns the poses recorded in the time range.
+
+        Args:
+            start(float): Start time in seconds since the epoch (inclusive)
+            end(float): End time in seconds since the epoch (exclusive)
+            objectId(int): If specified, only the objects with this index
+                in the frame are returned.
+
+        Returns:
+            Dict of numpy arrays, 'timestamp', 'frame' and 'object_id' with
+            shape (N,) and 'poses' with shape (N, parts, 2)
+        '''
+        with self._lock:
+            if self._idxFile is not None:
+                self._datFile.flush()
+                self._idxFile.flush()
+        with self._filesLock:
+            return self._query(start, end, objectId)
+
+    def _query(self, start, end, objectId):
+        timestamps = []
+        frames = []
+        objectIds = []
+        poses = []
+        for segment in self.segments():
+            if segment[0] >= end or segment[0] + segment[1] <= start:
+                continue
+            index = self._readIndex(segment)
+            if np.any(np.diff(index['timestamp']) < 0):
+                index = index[np.argsort(index['timestamp'], kind='stable')]
+            first = np.searchsorted(index['timestamp'], start, 'left')
+            last = np.searchsorted(index['timestamp'], end, 'left')
+            index = index[first:last]
+            if len(index) == 0:
+                continue
+            counts = index['count'].astype(np.int64)
+            offsets = index['offset'].astype(np.int64)
+            # Object index in the frame and row in the data file
+            starts = np.cumsum(counts) - counts
+            ids = np.arange(int(np.sum(counts))) - np.repeat(starts, counts)
+            rows = np.repeat(offsets, counts) + ids
+            if len(rows) == 0:
+                continue
+            begin = int(np.min(rows))
+            segPoses = self._readPoses( \
+                segment, begin, int(np.max(rows)) + 1)[rows - begin]
+            segTimestamps = np.repeat(index['timestamp'], counts)
+            segFrames = np.repeat(index['frame'], counts)
+            if objectId is not None:
+                mask = ids == objectId
+                ids = ids[mask]
+                segPoses = segPoses[mask]
+                segTimestamps = segTimestamps[mask]
+                segFrames = segFrames[mask]
+            timestamps.append(segTimestamps)
+            frames.append(segFrames)
+            objectIds.append(ids)
+            poses.append(segPoses)
+        if len(poses) == 0:
+            return {'timestamp': np.zeros(0), \
+                'frame': np.zeros(0, dtype=np.uint64), \
+                'object_id': np.zeros(0, dtype=np.int64), \
+                'poses': np.zeros((0, self.numParts, 2), dtype=np.float32)}
+        return {'timestamp': np.concatenate(timestamps), \
+            'frame': np.concatenate(frames), \
+            'object_id': np.concatenate(objectIds), \
+            'poses': np.concatenate(poses)}
+
+    def compact(self, retention, mergeAge=86400, mergeLength=86400, \
+        now=None):
+        '''Deletes the expired segments and merges the old segments.
+        The appends are not blocked while compacting.
+
+        Args:
+            retention(float): Segments ended before this number of seconds
+                ago are deleted. If None, nothing is deleted.
+            mergeAge(float): The segments of a mergeLength period ended
+                before this number of seconds ago are merged into a segment
+                of mergeLength. A merged segment is never merged again.
+            mergeLength(int): Length of the merged segments in second
+            now(float): Current time, for testing
+        '''
+        if now is None:
+            now = time.time()
+        with self._compactLock:
+            self._compact(retention, mergeAge, mergeLength, now)
+
+    def _compact(self, retention, mergeAge, mergeLength, now):
+        with self._lock:
+            current = self._segment
+        groups = {}
+        merged = set()
+        # The period still written is not merged
+        busy = None
+        if current is not None:
+            busy = current[0] // mergeLength * mergeLength
+        for segment in self.segments():
+            if segment == current:
+                continue
+            segEnd = segment[0] + segment[1]
+            if retention is not None and segEnd <= now - retention:
+                logging.info('Pose store expired: %s' \
+                    % (self._segmentPath(segment, '')))
+                self._remove([segment])
+                continue
+            start = segment[0] // mergeLength * mergeLength
+            if segment == (start, mergeLength):
+                merged.add(start)
+            elif segEnd <= start + mergeLength and start != busy \
+                and start + mergeLength <= now - mergeAge:
+                groups.setdefault(start, []).append(segment)
+        for start, segments in groups.items():
+            if start in merged:
+                # Sources of a merge interrupted before removing them
+                logging.warning('Pose store removed merged segments: %s' \
+                    % (', '.join([self._segmentPath(s, '') \
+                    for s in segments])))
+                self._remove(segments)
+            elif len(segments) > 1:
+                self._merge(segments, (start, mergeLength))
+
+    def _remove(self, segments):
+        with self._filesLock:
+            for segment in segments:
+                os.unlink(self._segmentPath(segment, '.idx'))
+                os.unlink(self._segmentPath(segment, '.dat'))
+
+    def _merge(self, segments, merged):
+        index = []
+        offset = 0
+        tmpIdx = self._segmentPath(merged, '.idx.tmp')
+        tmpDat = self._segmentPath(merged, '.dat.tmp')
+        with open(tmpDat, 'wb') as f:
+            for segment in segments:
+                segIndex = self._readIndex(segment).copy()
+                index.append(segIndex)
+                if len(segIndex) == 0:
+                    continue
+                # The rows of a frame are contiguous, the frames are not
+                # always in the index order
+                counts = segIndex['count'].astype(np.int64)
+                offsets = segIndex['offset'].astype(np.int64)
+                starts = np.cumsum(counts) - counts
+                begin = int(np.min(offsets))
+                rows = np.repeat(offsets - begin - starts, counts) \
+                    + np.arange(int(np.sum(counts)))
+                data = self._readPoses( \
+                    segment, begin, int(np.max(offsets + counts)))
+                f.write(data[rows].astype('<f4').tobytes())
+                segIndex['offset'] = offset + starts
+                offset += int(np.sum(counts))
+        index = np.concatenate(index)
+        index = index[np.argsort(index['timestamp'], kind='stable')]
+        index.tofile(tmpIdx)
+        # The index is replaced last, the merged segment is listed only
+        # when complete
+        with self._filesLock:
+            os.replace(tmpDat, self._segmentPath(merged, '.dat'))
+            os.replace(tmpIdx, self._segmentPath(merged, '.idx'))
+            for segment in segments:
+                os.unlink(self._segmentPath(segment, '.idx'))
+                os.unlink(self._segmentPath(segment, '.dat'))
+        logging.info('Pose store merged %d segments into %s' \
+            % (len(segments), self._segmentPath(merged, '')))
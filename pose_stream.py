@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIT License
+#
+# Copyright (c) 2019, 2020 MACNICA Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+'''Pose result streaming over TCP or Unix domain sockets.
+
+Each frame is sent as a binary message:
+
+    +-------+---------+-----------+-------------+-----------+-------------+
+    | magic | seq     | timestamp | num_objects | num_parts | poses       |
+    | 4s    | uint64  | float64   | uint16      | uint16    | float32 x   |
+    |'POSE' |         | (epoch)   |             |           | N x P x 2   |
+    +-------+---------+-----------+-------------+-----------+-------------+
+
+All values are little endian. The poses are (x, y) pixel coordinates,
+missing keypoints are 0 as in the CSV output. Messages queued while a
+subscriber is busy are coalesced into a single send.
+'''
+
+import os
+import socket
+import struct
+import threading
+import collections
+import logging
+import numpy as np
+
+
+class PoseStreamError(Exception):
+    pass
+
+
+HEADER = struct.Struct('<4sQdHH')
+MAGIC = b'POSE'
+
+
+def encode(seq, timestamp, poses):
+    '''Encodes a frame of pose results.
+
+    Args:
+        seq(int): Frame sequence number
+        timestamp(float): Time stamp in seconds since the epoch
+        poses(numpy.ndarray): Pose array with shape (objects, parts, 2)
+
+    Returns:
+        Encoded message as bytes
+    '''
+    poses = np.ascontiguousarray(poses, dtype='<f4')
+    numObjects, numParts = poses.shape[0], poses.shape[1]
+    return HEADER.pack(MAGIC, seq, timestamp, numObjects, numParts) \
+        + poses.tobytes()
+
+
+def parseAddress(address):
+    '''Parses a stream address.
+
+    Args:
+        address(str): 'HOST:PORT' for TCP, otherwise a Unix socket path
+
+    Returns:
+        (family, address) tuple for socket.socket and bind/connect
+    '''
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (socket.AF_INET, (host, int(port)))
+    return (socket.AF_UNIX, address)
+
+
+def unlinkAddress(address):
+    '''Removes the socket file of a Unix domain socket address if exists.
+    '''
+    family, addr = parseAddress(address)
+    if family == socket.AF_UNIX and os.path.exists(addr):
+        os.unlink(addr)
+
+
+def listen(address, error=None):
+    '''Creates a listening socket. A socket file left at a Unix domain
+    socket address is replaced.
+
+    Args:
+        address(str): 'HOST:PORT' for TCP, otherwise a Unix socket path
+        error(type): Exception class raised on failure, PoseStreamError
+            if omitted
+
+    Returns:
+        Listening socket
+    '''
+    if error is None:
+        error = PoseStreamError
+    family, addr = parseAddress(address)
+    sock = None
+    try:
+        unlinkAddress(address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(addr)
+        sock.listen()
+    except OSError as e:
+        if sock is not None:
+            sock.close()
+        raise error('Could not listen on %s: %s' % (address, str(e)))
+    return sock
+
+
+def recvExact(sock, size):
+    '''Receives exactly size bytes.
+
+    Returns:
+        Received bytearray, or None if the connection is closed
+    '''
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = sock.recv_into(view[pos:], size - pos)
+        if n == 0:
+            return None
+        pos += n
+    return buf
+
+
+def recvMessage(sock):
+    '''Receives a message.
+
+    Returns:
+        (seq, timestamp, poses) tuple, or None if the connection is closed
+    '''
+    header = recvExact(sock, HEADER.size)
+    if header is None:
+        return None
+    magic, seq, timestamp, numObjects, numParts = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise PoseStreamError('Invalid message header')
+    size = numObjects * numParts * 2 * 4
+    body = recvExact(sock, size) if size > 0 else b''
+    if body is None:
+        return None
+    poses = np.frombuffer(body, dtype='<f4').reshape( \
+        (numObjects, numParts, 2))
+    return (seq, timestamp, poses)
+
+
+class PoseStreamSubscriber():
+    '''A connected subscriber with a bounded send buffer. The oldest
+    message is dropped when the buffer is full.
+
+    Attributes:
+        conn: Connected socket
+        buffer: Encoded messages waiting to be sent
+        numDrops: Total number of messages dropped for this subscriber
+    '''
+
+    label = 'Pose stream subscriber'
+
+    def __init__(self, conn, peer, maxMessages, batchBytes):
+        self.conn = conn
+        self.peer = peer
+        self.buffer = collections.deque()
+        self.maxMessages = maxMessages
+        self.batchBytes = batchBytes
+        self.numDrops = 0
+        self.alive = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+
+    def push(self, message):
+        with self.cond:
+            if not self.alive:
+                return
+            if len(self.buffer) >= self.maxMessages \
+                and not self._overflow():
+                return
+            self.buffer.append(message)
+            self.cond.notify()
+
+    def _overflow(self):
+        # Slow consumer, drop the oldest message
+        self.buffer.popleft()
+        self.numDrops += 1
+        return True
+
+    def close(self):
+        with self.cond:
+            self._shutdown()
+
+    def _shutdown(self):
+        self.alive = False
+        self.cond.notify()
+        # Unblocks the sender thread blocked by a consumer not reading
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        logging.info('%s %s connected' % (self.label, str(self.peer)))
+        try:
+            while True:
+                with self.cond:
+                    while self.alive and len(self.buffer) == 0:
+                        self.cond.wait()
+                    if not self.alive:
+                        break
+                    batch = []
+                    size = 0
+                    while len(self.buffer) > 0 and size < self.batchBytes:
+                        message = self.buffer.popleft()
+                        batch.append(message)
+                        size += len(message)
+                self.conn.sendall(b''.join(batch))
+        except OSError as e:
+            logging.info('%s %s: %s' % (self.label, str(self.peer), str(e)))
+        self.alive = False
+        self.conn.close()
+        logging.info('%s %s disconnected (%d drops)' \
+            % (self.label, str(self.peer), self.numDrops))
+
+
+class PoseStreamServer():
+    '''Publishes pose results to multiple subscribers.
+
+    Attributes:
+        address: Listening address
+        subscribers: List of the connected PoseStreamSubscriber objects
+        seq: Sequence number of the next published frame
+    '''
+
+    def __init__(self, address, maxMessages=64, batchBytes=65536):
+        '''
+        Args:
+            address(str): 'HOST:PORT' for TCP, otherwise a Unix socket path
+            maxMessages(int): Send buffer capacity of each subscriber
+            batchBytes(int): Maximum bytes coalesced into a single send
+        '''
+        self.address = address
+        self.maxMessages = maxMessages
+        self.batchBytes = batchBytes
+        self.subscribers = []
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.sock = listen(address)
+        self.flag = True
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.thread.start()
+        logging.info('Pose stream server listening on %s' % (address))
+
+    def _accept(self):
+        while self.flag:
+            try:
+                conn, peer = self.sock.accept()
+            except OSError:
+                break
+            if conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            subscriber = PoseStreamSubscriber( \
+                conn, peer if peer else self.address, \
+                self.maxMessages, self.batchBytes)
+            with self.lock:
+                self.subscribers = \
+                    [s for s in self.subscribers if s.alive] + [subscriber]
+            subscriber.thread.start()
+
+    def publish(self, timestamp, poses):
+        '''Publishes a frame of pose results to all subscribers.
+        The message is encoded once and never blocks on the subscribers.
+
+        Args:
+            timestamp(float): Time stamp in seconds since the epoch
+            poses(numpy.ndarray): Pose array with shape (objects, parts, 2)
+        '''
+        with self.lock:
+            seq = self.seq
+            self.seq += 1
+            subscribers = self.subscribers
+        if len(subscribers) == 0:
+            return
+        message = encode(seq, timestamp, poses)
+        for subscriber in subscribers:
+            if subscriber.alive:
+                subscriber.push(message)
+
+    def close(self):
+        '''Stops accepting and disconnects all subscribers.
+        '''
+        self.flag = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        with self.lock:
+            subscribers = self.subscribers
+            self.subscribers = []
+        for subscriber in subscribers:
+            subscriber.close()
+            subscriber.thread.join()
+        unlinkAddress(self.address)
+
+
+def subscribe(address):
+    '''Connects to a pose stream server and yields the received frames.
+
+    Args:
+        address(str): 'HOST:PORT' for TCP, otherwise a Unix socket path
+
+    Yields:
+        (seq, timestamp, poses) tuple, poses is a float32 numpy array
+        with shape (objects, parts, 2)
+    '''
+    family, addr = parseAddress(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(addr)
+        while True:
+            message = recvMessage(sock)
+            if message is None:
+                return
+            yield message
@@ -28,34 +28,63 @@
 
 import sys
 import os
+import time
 import cv2
+import numpy as np
 import pose_capture
+import pose_stream
+import pose_store
+import pose_remote
+import pose_analytics
 import video_app_utils
+from draw_objects import drawPoses
 import argparse
 import logging
+import signal
 
 
 class ColorConvert(video_app_utils.PipelineWorker):
     
-    def __init__(self, qsize, source):
+    def __init__(self, qsize, source, pool=None):
         super().__init__(qsize, source)
+        self.stride = 1
+        self.count = 0
+        self.pool = pool
         
     def process(self, srcData):
+        self.count += 1
         orgFrame = srcData
-        frame = cv2.cvtColor(orgFrame, cv2.COLOR_BGR2RGB)
+        if self.count % self.stride != 0:
+            # Skip the inference for the frame stride, the frame is passed
+            # through to be displayed with the last results
+            return (True, (None, orgFrame))
+        dst = None
+        if self.pool is not None:
+            dst = self.pool.acquire(orgFrame.shape)
+        frame = cv2.cvtColor(orgFrame, cv2.COLOR_BGR2RGB, dst=dst)
         return (True, (frame, orgFrame))
 
         
 class Resize(video_app_utils.PipelineWorker):
 
-    def __init__(self, qsize, source, inRes):
+    def __init__(self, qsize, source, switcher, pool=None):
         super().__init__(qsize, source)
-        self.inRes = inRes
+        self.switcher = switcher
+        self.pool = pool
         
     def process(self, srcData):
         frame, orgFrame = srcData
-        frame = cv2.resize(frame, self.inRes, interpolation=cv2.INTER_NEAREST)
-        return (True, (frame, orgFrame))
+        if frame is None:
+            return (True, (None, orgFrame, None))
+        # The model is fixed here for the rest of the stages of this frame
+        model = self.switcher.current()
+        width, height = model.getInputRes()
+        dst = None
+        if self.pool is not None:
+            dst = self.pool.acquire((height, width, frame.shape[2]))
+        frame = cv2.resize(frame, (width, height), dst=dst, \
+            interpolation=cv2.INTER_NEAREST)
+        return (True, (frame, orgFrame, model))
         
 
 '''       
@@ -79,63 +108,322 @@ class ResizeGpu(video_app_utils.PipelineWorker):
 
 class Preprocess(video_app_utils.PipelineWorker):
     
-    def __init__(self, qsize, source, model):
+    def __init__(self, qsize, source):
         super().__init__(qsize, source)
-        self.model = model
         
     def process(self, srcData):
-        frame, orgFrame = srcData
-        frame = self.model.preprocess(frame)
-        return (True, (frame, orgFrame))
+        frame, orgFrame, model = srcData
+        if frame is None:
+            return (True, srcData)
+        frame = model.preprocess(frame)
+        return (True, (frame, orgFrame, model))
 
         
 class Inference(video_app_utils.PipelineWorker):
     
-    def __init__(self, qsize, source, model):
+    def __init__(self, qsize, source):
         super().__init__(qsize, source)
-        self.model = model
         
     def process(self, srcData):
-        frame, orgFrame = srcData
-        cmap, paf = self.model.infer(frame)
-        return (True, (cmap, paf, orgFrame))
+        frame, orgFrame, model = srcData
+        if frame is None:
+            return (True, (None, None, orgFrame, None))
+        cmap, paf = model.infer(frame)
+        return (True, (cmap, paf, orgFrame, model))
 
         
 class Postprocess(video_app_utils.PipelineWorker):
     
-    def __init__(self, qsize, source, model):
+    def __init__(self, qsize, source, publishers=()):
         super().__init__(qsize, source)
-        self.model = model
         self.cont = True
-        
+        self.publishers = list(publishers)
+        self.lastResults = None
+
     def process(self, srcData):
-        cmap, paf, orgFrame = srcData
+        cmap, paf, orgFrame, model = srcData
         if not self.cont:
             return (True, None)
-        self.cont = self.model.postprocess(cmap, paf, orgFrame)
-        return (True, orgFrame)
+        if cmap is None:
+            # Skipped by the frame stride
+            return (True, (orgFrame, None))
+        results = []
+        listener = lambda timestamp, poses: results.append(poses)
+        self.cont = model.postprocess(cmap, paf, orgFrame, listener)
+        height, width = orgFrame.shape[:2]
+        poses = results[0] / np.array([width, height], dtype=np.float32)
+        return (True, (orgFrame, (results[0], poses, model)))
+
+    def complete(self, output):
+        if output is None:
+            return None
+        orgFrame, results = output
+        if results is None:
+            # The last results in the capture order are drawn again
+            if self.lastResults is not None:
+                pixels, poses, model = self.lastResults
+                if model.overlay:
+                    drawPoses(orgFrame, poses, model.skeleton)
+            return orgFrame
+        self.lastResults = results
+        # Published in the capture order, also with parallel replicas
+        timestamp = time.time()
+        for publisher in self.publishers:
+            publisher.publish(timestamp, results[0])
+        return orgFrame
+
+
+class StrideKnob(video_app_utils.QualityKnob):
+    '''Processes only every N-th captured frame.
+    '''
+
+    def __init__(self, worker, maxStride=4):
+        super().__init__('stride')
+        self.worker = worker
+        self.minStride = worker.stride
+        self.maxStride = maxStride
+
+    def degrade(self):
+        if self.worker.stride >= self.maxStride:
+            return False
+        self.worker.stride += 1
+        return True
+
+    def restore(self):
+        if self.worker.stride <= self.minStride:
+            return False
+        self.worker.stride -= 1
+        return True
+
+    def describe(self):
+        return '%d' % (self.worker.stride)
+
+
+class OverlayKnob(video_app_utils.QualityKnob):
+    '''Turns off drawing the pose estimation results on the frames.
+    '''
+
+    def __init__(self, switcher):
+        super().__init__('overlay')
+        self.switcher = switcher
+
+    def degrade(self):
+        model = self.switcher.current()
+        if not model.overlay:
+            return False
+        model.overlay = False
+        return True
+
+    def restore(self):
+        model = self.switcher.current()
+        if model.overlay:
+            return False
+        model.overlay = True
+        return True
+
+    def describe(self):
+        return 'on' if self.switcher.current().overlay else 'off'
+
+
+class ModelKnob(video_app_utils.QualityKnob):
+    '''Swaps to the next lighter model in the switcher models list.
+    The models list should be ordered from the most accurate.
+    '''
+
+    def __init__(self, switcher):
+        super().__init__('model')
+        self.switcher = switcher
+
+    def level(self):
+        '''Returns the index of the current model in the models list.
+        The model can also be swapped by a signal or the control socket.
+        '''
+        modelFile = self.switcher.current().modelFile
+        if modelFile in self.switcher.models:
+            return self.switcher.models.index(modelFile)
+        return 0
+
+    def _swap(self, level):
+        # Fails while the previous swap is in progress
+        return self.switcher.requestSwap(self.switcher.models[level])
+
+    def degrade(self):
+        level = self.level()
+        if level + 1 >= len(self.switcher.models):
+            return False
+        return self._swap(level + 1)
+
+    def restore(self):
+        level = self.level()
+        if level == 0:
+            return False
+        return self._swap(level - 1)
+
+    def describe(self):
+        loading = self.switcher.loading()
+        if loading is not None:
+            return '%s (loading)' % (os.path.basename(loading))
+        return os.path.basename(self.switcher.current().modelFile)
+
+
+class ResolutionKnob(video_app_utils.QualityKnob):
+    '''Scales down the capture size.
+    '''
+
+    SCALES = (1.0, 0.75, 0.5)
+
+    def __init__(self, capture, width, height):
+        super().__init__('resolution')
+        self.capture = capture
+        self.width = width
+        self.height = height
+        self.level = 0
+
+    def _apply(self, level):
+        scale = ResolutionKnob.SCALES[level]
+        if not self.capture.requestResolution( \
+            int(self.width * scale), int(self.height * scale)):
+            return False
+        self.level = level
+        return True
+
+    def degrade(self):
+        if self.level + 1 >= len(ResolutionKnob.SCALES):
+            return False
+        return self._apply(self.level + 1)
+
+    def restore(self):
+        if self.level == 0:
+            return False
+        return self._apply(self.level - 1)
+
+    def describe(self):
+        scale = ResolutionKnob.SCALES[self.level]
+        return '%dx%d' % (int(self.width * scale), int(self.height * scale))
 
 
 class PoseEstimationProcess(video_app_utils.ContinuousVideoProcess):
 
-    def __init__(self, args):
+    def __init__(self, args, publisher=None):
         '''
         [Capture]->[Color Convert]->[Resize]->[Pre-process]->
         ->[Infer]->[Post-process]->[Display]
+
+        With a remote inference server:
+        [Capture]->[Color Convert]->[Resize]->[Remote Infer]->
+        ->[Remote Post-process]->[Display]
+
+        Args:
+            args(argparse.Namespace): Command-line arguments
+            publisher: If specified, its publish method is called with
+                the time stamp and the pose array of each frame
         '''
         super().__init__(args)
-        model = pose_capture.PoseCaptureModel( \
-            args.model, args.task, args.csv, args.csvpath)
-        inRes = model.getInputRes()
-        colorConv = ColorConvert(args.qsize, self.capture)
-        resize = Resize(args.qsize, colorConv, inRes)
-        preprocess = Preprocess(args.qsize, resize, model)    
-        inference = Inference(args.qsize, preprocess, model)  
-        postprocess = Postprocess(args.qsize, inference, model)
+        torchThreads = args.torch_threads
+        if torchThreads < 0:
+            torchThreads = video_app_utils.autoNumThreads()
+        pose_capture.setNumThreads(torchThreads)
+        self.switcher = None
+        client = None
+        if args.remote is not None:
+            client = pose_remote.RemoteInferenceClient(args.remote)
+            numParts = len(client.keypoints)
+        else:
+            model = pose_capture.PoseCaptureModel(args.model, args.task, \
+                args.csv, args.csvpath, args.precision == 'fp16')
+            numParts = model.num_parts
+            models = [args.model]
+            if args.alt_models is not None:
+                models += args.alt_models.split(',')
+            self.switcher = pose_capture.PoseCaptureModelSwitcher( \
+                model, args.task, models)
+            if args.control is not None:
+                self.switcher.serveControl(args.control)
+        publishers = []
+        if publisher is not None:
+            publishers.append(publisher)
+        self.publisher = None
+        if args.stream is not None:
+            self.publisher = pose_stream.PoseStreamServer(args.stream)
+            publishers.append(self.publisher)
+        self.store = None
+        if args.store is not None:
+            if args.src_file is not None:
+                camera = os.path.basename(args.src_file)
+            else:
+                camera = 'camera%d' % (args.camera)
+            retention = None
+            if args.retention is not None:
+                retention = args.retention * 86400
+            self.store = pose_store.PoseStore( \
+                args.store, camera, numParts, retention=retention)
+            if retention is not None:
+                self.store.compact(retention)
+            publishers.append(self.store)
+        self.analytics = None
+        if args.analytics is not None:
+            self.analytics = pose_analytics.PoseAnalytics( \
+                numParts, args.cell_size, args.half_life)
+            self.analytics.serve(args.analytics)
+            publishers.append(self.analytics)
+        colorConv = ColorConvert(args.qsize, self.capture, self.framePool)
+        colorConv.stride = args.stride
+        if client is not None:
+            resize = Resize(args.qsize, colorConv, client, self.framePool)
+            inference = pose_remote.RemoteInference( \
+                args.qsize, resize, client, args.window)
+            postprocess = pose_remote.RemotePostprocess( \
+                args.qsize, inference, publishers)
+        else:
+            resize = Resize( \
+                args.qsize, colorConv, self.switcher, self.framePool)
+            preprocess = self.createStage( \
+                Preprocess, args.qsize, resize, args.pre_replicas)
+            inference = Inference(args.qsize, preprocess)  
+            postprocess = self.createStage(Postprocess, args.qsize, \
+                inference, args.post_replicas, publishers)
+        if args.adapt is not None:
+            knobs = []
+            for name in args.adapt.split(','):
+                if name == 'stride':
+                    knobs.append(StrideKnob(colorConv))
+                elif name in ('overlay', 'model') and self.switcher is None:
+                    raise video_app_utils.VideoAppUtilsError( \
+                        'Quality knob %s is not available with --remote' \
+                        % (name))
+                elif name == 'overlay':
+                    knobs.append(OverlayKnob(self.switcher))
+                elif name == 'model':
+                    knobs.append(ModelKnob(self.switcher))
+                elif name == 'resolution':
+                    knobs.append(ResolutionKnob( \
+                        self.capture, args.width, args.height))
+                else:
+                    raise video_app_utils.VideoAppUtilsError( \
+                        'Invalid quality knob: %s' % (name))
+            targetLatency = None
+            if args.target_latency is not None:
+                targetLatency = args.target_latency / 1000.0
+            self.controller = video_app_utils.AdaptiveQualityController( \
+                self, knobs, args.target_fps, targetLatency)
+
+    def threadLayout(self):
+        lines = super().threadLayout()
+        lines[0] += ', PyTorch threads: %d' % (pose_capture.getNumThreads())
+        return lines
+
+    def stopPipeline(self):
+        super().stopPipeline()
+        if getattr(self, 'publisher', None) is not None:
+            self.publisher.close()
+            self.publisher = None
+        if getattr(self, 'store', None) is not None:
+            self.store.close()
+        if getattr(self, 'analytics', None) is not None:
+            self.analytics.close()
   
         
-def main():
-    # Parse the command line parameters
+def argumentParser():
     cvpParser = video_app_utils.ContinuousVideoProcess.argumentParser( \
         width=800, height=600)
     parser = argparse.ArgumentParser( \
@@ -145,6 +433,17 @@ def main():
         default='resnet18_baseline_att_224x224_A_epoch_249.pth', \
         metavar='MODEL', \
         help='Model weight file')
+    parser.add_argument('--precision', \
+        type=str, \
+        default='fp16', \
+        choices=('fp16', 'fp32'), \
+        help='TensorRT inference precision')
+    parser.add_argument('--stride', \
+        type=int, \
+        default=1, \
+        metavar='STRIDE', \
+        help='Run the inference on every STRIDE-th captured frame, the other \
+            frames are displayed with the last results')
     parser.add_argument('--task', \
         type=str, \
         default='human_pose.json', \
@@ -160,9 +459,100 @@ def main():
         default=os.path.join('.', 'csv'), \
         metavar='CSV_PATH', \
         help='Directory path to save CSV files')
+    parser.add_argument('--torch-threads', \
+        type=int, \
+        default=-1, \
+        metavar='NUM', \
+        help='PyTorch intra-op thread pool size, negative for automatic')
+    parser.add_argument('--pre-replicas', \
+        type=int, \
+        default=1, \
+        metavar='NUM', \
+        help='Number of parallel pre-process workers')
+    parser.add_argument('--post-replicas', \
+        type=int, \
+        default=1, \
+        metavar='NUM', \
+        help='Number of parallel post-process workers')
+    parser.add_argument('--stream', \
+        type=str, \
+        default=None, \
+        metavar='ADDRESS', \
+        help='Publish pose results on HOST:PORT or a Unix socket path')
+    parser.add_argument('--store', \
+        type=str, \
+        default=None, \
+        metavar='STORE_PATH', \
+        help='Directory path of the time-indexed pose store')
+    parser.add_argument('--retention', \
+        type=float, \
+        default=None, \
+        metavar='DAYS', \
+        help='Delete the pose store data older than DAYS at start and \
+            hourly')
+    parser.add_argument('--analytics', \
+        type=str, \
+        default=None, \
+        metavar='ADDRESS', \
+        help='Serve the live pose analytics on HOST:PORT or a Unix socket \
+            path')
+    parser.add_argument('--cell-size', \
+        type=int, \
+        default=32, \
+        metavar='PIXELS', \
+        help='Grid cell size of the analytics heatmaps and zones')
+    parser.add_argument('--half-life', \
+        type=float, \
+        default=60.0, \
+        metavar='SEC', \
+        help='Half-life of the decayed averages of the analytics')
+    parser.add_argument('--adapt', \
+        type=str, \
+        default=None, \
+        metavar='KNOBS', \
+        help='Comma separated quality knobs (stride, overlay, resolution, \
+            model) adjusted in this order to meet the targets')
+    parser.add_argument('--target-fps', \
+        type=float, \
+        default=None, \
+        metavar='FPS', \
+        help='Target frame rate for the --adapt option')
+    parser.add_argument('--target-latency', \
+        type=float, \
+        default=None, \
+        metavar='MSEC', \
+        help='Target end-to-end latency for the --adapt option')
+    parser.add_argument('--alt-models', \
+        type=str, \
+        default=None, \
+        metavar='MODELS', \
+        help='Comma separated model weight files to swap at runtime \
+            by SIGUSR1, the control socket or the model quality knob')
+    parser.add_argument('--control', \
+        type=str, \
+        default=None, \
+        metavar='ADDRESS', \
+        help='Accept model swap commands on HOST:PORT or a Unix socket path')
+    parser.add_argument('--remote', \
+        type=str, \
+        default=None, \
+        metavar='ADDRESS', \
+        help='Use the inference server on HOST:PORT or a Unix socket path \
+            instead of the local model')
+    parser.add_argument('--window', \
+        type=int, \
+        default=4, \
+        metavar='NUM', \
+        help='Maximum number of the remote inference requests in flight')
     parser.add_argument('--verbose', \
         action='store_true', \
         help='If set, print debug message')
+    return parser
+
+
+def main():
+    # Parse the command line parameters
+    parser = argumentParser()
     args = parser.parse_args()
     # Set the logging level
     if args.verbose:
@@ -170,9 +560,23 @@ def main():
     # Create continuous video process and start it
     try :
         vproc = PoseEstimationProcess(args)
+        if vproc.switcher is not None:
+            signal.signal(signal.SIGUSR1, \
+                lambda signum, frame: vproc.switcher.nextModel())
+        if vproc.profiler is not None:
+            signal.signal(signal.SIGUSR2, \
+                lambda signum, frame: vproc.profiler.dump())
         vproc.execute()
     except pose_capture.PoseCaptureError as err:
         print('Application error: %s' % (str(err)))
+    except pose_stream.PoseStreamError as err:
+        print('Pose stream error: %s' % (str(err)))
+    except pose_store.PoseStoreError as err:
+        print('Pose store error: %s' % (str(err)))
+    except pose_remote.PoseRemoteError as err:
+        print('Pose remote error: %s' % (str(err)))
+    except pose_analytics.PoseAnalyticsError as err:
+        print('Pose analytics error: %s' % (str(err)))
     except video_app_utils.VideoAppUtilsError as err:
         print('Video application framewrok error: %s' % (str(err)))
     
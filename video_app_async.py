@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIT License
+#
+# Copyright (c) 2019, 2020 MACNICA Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+'''An asyncio runtime for the video_app_utils pipeline stages.
+
+The same PipelineWorker objects used by the threaded runtime are run as
+coroutines connected by asyncio queues. The worker threads of the
+PipelineWorker objects are never started, the blocking getData and process
+methods are called in an executor instead. So the stages putting their
+outputs from their own threads, such as the remote inference, are not
+supported.
+
+    vproc = PoseEstimationProcess(args)
+    pipeline = AsyncPipeline.fromProcess(vproc)
+    pipeline.start()
+    async for frame in pipeline:
+        ...
+    await pipeline.stop()
+
+The results published by a stage, such as the poses of the post-process,
+can be awaited with an AsyncPublisher.
+'''
+
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import logging
+from video_app_utils import VideoAppUtilsError, VideoAppUtilsEosError
+from video_app_utils import PipelineWorker, ParallelPipelineWorker
+
+
+class AsyncPipelineStage():
+    '''A coroutine running a PipelineWorker object.
+
+    Attributes:
+        worker: PipelineWorker object which implements the stage
+        queue: asyncio queue to store outputs processed by this stage
+        source: Source AsyncPipelineStage object. If None, the getData
+            method of the worker is used as the data source.
+        drop: If true, the oldest output is dropped when the queue is full.
+        numDrops: Total number of dropped outputs.
+    '''
+
+    _EOS = object()
+
+    def __init__(self, worker, qsize, source=None, drop=True):
+        '''
+        Args:
+            worker(PipelineWorker): Stage implementation
+            qsize(int): Output queue capacity
+            source(AsyncPipelineStage): Data source
+        '''
+        self.worker = worker
+        self.queue = asyncio.Queue(qsize)
+        self.source = source
+        self.drop = drop
+        self.numDrops = 0
+        self._eos = False
+
+    def __repr__(self):
+        return '%02d %06d' % (self.queue.qsize(), self.numDrops)
+
+    async def _put(self, dat):
+        if self.drop and self.queue.full():
+            self.queue.get_nowait()
+            self.numDrops += 1
+        await self.queue.put(dat)
+
+    async def _emit(self, future, executor):
+        try:
+            ret, dat = await future
+            if ret is None:
+                return True
+            if ret == False:
+                logging.info('Processing error')
+                return False
+            complete = self.replicas()[0].complete
+            if type(self.replicas()[0]).complete is not PipelineWorker.complete:
+                # Awaited before the next output, so called in the input order
+                dat = await asyncio.get_running_loop().run_in_executor( \
+                    executor, complete, dat)
+        except Exception as e:
+            logging.critical(e)
+            return False
+        await self._put(dat)
+        return True
+
+    async def run(self, executor):
+        '''Stage coroutine, runs until the end of stream.
+        The replicas of a ParallelPipelineWorker are run concurrently
+        and their outputs are emitted in the input order.
+
+        Args:
+            executor(concurrent.futures.Executor): Executor to run
+                the blocking methods of the worker
+        '''
+        loop = asyncio.get_running_loop()
+        name = self.worker.__class__.__name__
+        processors = [r.process for r in self.replicas()]
+        pending = collections.deque()
+        count = 0
+        logging.info('%s coroutine started' % (name))
+        try:
+            while True:
+                try:
+                    if self.source is None:
+                        src = await loop.run_in_executor( \
+                            executor, self.worker.getData)
+                    else:
+                        src = await self.source.get()
+                except VideoAppUtilsEosError:
+                    logging.info('End of Stream detected')
+                    break
+                pending.append(loop.run_in_executor( \
+                    executor, processors[count % len(processors)], src))
+                count += 1
+                if len(pending) < len(processors):
+                    continue
+                if not await self._emit(pending.popleft(), executor):
+                    break
+            while len(pending) > 0:
+                if not await self._emit(pending.popleft(), executor):
+                    break
+            # Waits for the consumer unless the drop feature is enabled
+            await self._put(AsyncPipelineStage._EOS)
+        except BaseException:
+            # Cancelled, the end of stream marker is never dropped
+            while self.queue.full():
+                self.queue.get_nowait()
+            self.queue.put_nowait(AsyncPipelineStage._EOS)
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+            logging.info('%s coroutine terminated' % (name))
+
+    def replicas(self):
+        '''Returns the workers which process the inputs of this stage.
+        '''
+        if isinstance(self.worker, ParallelPipelineWorker):
+            return self.worker.replicas
+        return [self.worker]
+
+    async def get(self):
+        '''Gets an output.
+
+        Raises:
+            VideoAppUtilsEosError: The stage reached the end of stream.
+        '''
+        if self._eos:
+            raise VideoAppUtilsEosError
+        dat = await self.queue.get()
+        if dat is AsyncPipelineStage._EOS:
+            self._eos = True
+            raise VideoAppUtilsEosError
+        return dat
+
+
+class AsyncPipeline():
+    '''A chain of AsyncPipelineStage objects.
+
+    Attributes:
+        stages(list): List of the stages from the data source to the sink
+        executor: Executor to run the blocking stage methods
+    '''
+
+    def __init__(self, workers, qsize=1, drop=True, executor=None):
+        '''
+        Args:
+            workers(list): PipelineWorker objects from the data source
+                to the sink
+            qsize(int): Queue capacity of each stage
+            drop(bool): If false, disable frame drop feature
+            executor(concurrent.futures.Executor): If ommited, a thread pool
+                with a thread per stage replica and a thread per stage for
+                the complete method is created.
+        '''
+        if len(workers) == 0:
+            raise VideoAppUtilsError('No pipeline stage')
+        for worker in workers:
+            if not worker.synchronous:
+                raise VideoAppUtilsError( \
+                    'Stage not supported by the asyncio runtime: %s' \
+                    % (worker.stageName()))
+        self.stages = []
+        source = None
+        for worker in workers:
+            source = AsyncPipelineStage(worker, qsize, source, drop)
+            self.stages.append(source)
+        self._ownExecutor = executor is None
+        if executor is None:
+            numThreads = sum([len(stage.replicas()) + 1 \
+                for stage in self.stages])
+            executor = concurrent.futures.ThreadPoolExecutor( \
+                max_workers=numThreads)
+        self.executor = executor
+        self._tasks = []
+
+    def __repr__(self):
+        return repr(self.stages[::-1])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.get()
+        except VideoAppUtilsEosError:
+            raise StopAsyncIteration
+
+    def start(self):
+        '''Schedules the stage coroutines in the running event loop.
+        '''
+        self._tasks = [asyncio.ensure_future(stage.run(self.executor)) \
+            for stage in self.stages]
+
+    async def get(self):
+        '''Gets an output of the last stage.
+
+        Raises:
+            VideoAppUtilsEosError: The pipeline reached the end of stream.
+        '''
+        return await self.stages[-1].get()
+
+    async def stop(self):
+        '''Cancels the stage coroutines and waits for their termination.
+        '''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._ownExecutor:
+            self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def fromProcess(vproc):
+        '''Creates an AsyncPipeline from a ContinuousVideoProcess object.
+        The pipeline of the ContinuousVideoProcess object should not be
+        started.
+
+        Args:
+            vproc(ContinuousVideoProcess): Video process which built
+                the pipeline
+
+        Returns:
+            AsyncPipeline object
+        '''
+        vproc.scanPipeline()
+        workers = vproc.pipeline[::-1]
+        qsize = workers[0].queue.maxsize
+        return AsyncPipeline(workers, qsize, not vproc.nodrop)
+
+
+class AsyncPublisher():
+    '''A publisher which can be awaited by coroutines. The publish method
+    is called from the executor threads, for example by the post-process
+    stage, and the oldest message is dropped when the queue is full.
+
+        publisher = AsyncPublisher()
+        vproc = PoseEstimationProcess(args, publisher)
+        ...
+        async for timestamp, poses in publisher:
+            ...
+
+    Attributes:
+        numDrops: Total number of dropped messages
+    '''
+
+    def __init__(self, maxsize=64):
+        '''
+        Args:
+            maxsize(int): Maximum number of the queued messages
+        '''
+        self.numDrops = 0
+        self._messages = collections.deque(maxlen=maxsize)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._event = None
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.get()
+        except VideoAppUtilsEosError:
+            raise StopAsyncIteration
+
+    def _wake(self):
+        # The event loop is known after the first get
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # The event loop was closed
+            pass
+
+    def publish(self, timestamp, poses):
+        '''Queues a message. Thread safe.
+        '''
+        with self._lock:
+            if len(self._messages) == self._messages.maxlen:
+                self.numDrops += 1
+            self._messages.append((timestamp, poses))
+            self._wake()
+
+    def close(self):
+        '''Ends the messages. Thread safe.
+        '''
+        with self._lock:
+            self._closed = True
+            self._wake()
+
+    async def get(self):
+        '''Gets a message, (timestamp, poses) tuple.
+
+        Raises:
+            VideoAppUtilsEosError: The publisher was closed and all
+                the messages were consumed.
+        '''
+        while True:
+            with self._lock:
+                if self._loop is None:
+                    self._loop = asyncio.get_running_loop()
+                    self._event = asyncio.Event()
+                if len(self._messages) > 0:
+                    return self._messages.popleft()
+                if self._closed:
+                    raise VideoAppUtilsEosError
+                self._event.clear()
+            await self._event.wait()
@@ -28,6 +28,7 @@
 '''A collection of utility classes for video applications.
 '''
 
+import os
 import sys
 import queue
 import threading
@@ -37,6 +38,9 @@ import numpy as np
 import argparse
 import datetime
 import logging
+import collections
+import weakref
+import signal
 
 
 class VideoAppUtilsError(Exception):
@@ -70,7 +74,18 @@ class PipelineWorker():
         flag: If ture, the processing loop is running.
         numDrops: Total number of dropped outputs.
         thread: Worker thread runs the _run instance method.
+        cpus: CPU set the worker thread is bound to. If None, not bound.
+        serviceTime: Moving average of the process method time in second
+        numProcessed: Total number of the process method calls
+        fusible: If true, the process method returns its output
+            synchronously and the stage can be fused with the neighbours.
+        synchronous: If true, the process method returns its output.
+            If false, the outputs are put by a thread started by the start
+            method, and the stage can be run only by the threaded runtime.
     '''
+
+    fusible = True
+    synchronous = True
     
     def __init__(self, qsize, source=None, drop=True):
         '''
@@ -88,6 +103,10 @@ class PipelineWorker():
         self.sem = threading.Semaphore(1)
         self.flag = False
         self.numDrops = 0
+        self.cpus = None
+        self.serviceTime = 0.0
+        self.numProcessed = 0
+        self._primed = collections.deque()
         self._error = False
     
     def __del__(self):
@@ -95,6 +114,16 @@ class PipelineWorker():
 
     def __repr__(self):
         return '%02d %06d' % (self.qsize(), self.numDrops)
+
+    def stageName(self):
+        '''Returns the stage name used for the thread names.
+        '''
+        return self.__class__.__name__
+
+    def bindThread(self):
+        '''Binds the calling thread to the CPU set of this worker.
+        '''
+        bindCurrentThread(self.stageName(), self.cpus)
         
     def process(self, srcData):
         '''Data processing(producing) method called in thread loop.
@@ -102,8 +131,39 @@ class PipelineWorker():
         
         Args:
             srcData: Source data 
+
+        Returns:
+            (ret, output) tuple. If ret is False, the processing error is
+            assumed. If ret is None, the input is skipped without output.
         '''
         return (False, None)
+
+    def complete(self, output):
+        '''Called with each output of the process method in the input
+        order, also when the stage is run by parallel replicas. Derived
+        classes can implement the order sensitive part of the processing
+        here.
+
+        Returns:
+            The output to be queued
+        '''
+        return output
+
+    def timedProcess(self, srcData):
+        '''Calls the process and the complete methods and updates
+        the service time.
+        '''
+        startTime = time.perf_counter()
+        result = self.process(srcData)
+        if result[0]:
+            result = (result[0], self.complete(result[1]))
+        elapsed = time.perf_counter() - startTime
+        if self.numProcessed == 0:
+            self.serviceTime = elapsed
+        else:
+            self.serviceTime += (elapsed - self.serviceTime) * 0.1
+        self.numProcessed += 1
+        return result
         
     def getData(self):
         '''Returns a output to data consumer.
@@ -115,6 +175,7 @@ class PipelineWorker():
         
     def __run(self):
         logging.info('%s thread started' % (self.__class__.__name__))
+        self.bindThread()
         with self.sem:
             self.flag = True
         while True:
@@ -129,7 +190,9 @@ class PipelineWorker():
                 logging.info('End of Stream detected')
             else:
                 try:
-                    ret, dat = self.process(src)
+                    ret, dat = self.timedProcess(src)
+                    if ret is None:
+                        continue
                     if ret == False:
                         self._error = True
                         dat = None
@@ -138,11 +201,27 @@ class PipelineWorker():
                     self._error = True
                     dat = None
                     logging.critical(e)
-            if self.drop and self.queue.full():
-                self.queue.get(block=True)
-                self.numDrops += 1
-            self.queue.put(dat)
+            self.put(dat)
         logging.info('%s thread terminated' % (self.__class__.__name__))
+
+    def put(self, dat):
+        '''Puts an output to the queue. If the drop feature is enabled and
+        the queue is full, the oldest output is dropped.
+        '''
+        if self.drop and self.queue.full():
+            self.queue.get(block=True)
+            self.numDrops += 1
+        self.queue.put(dat)
+
+    def prime(self, outputs):
+        '''Queues outputs produced before the worker thread is started.
+        They are returned by the get method ahead of the queue. If the drop
+        feature is enabled, only the newest queue capacity outputs are kept.
+        '''
+        self._primed.extend(outputs)
+        while self.drop and len(self._primed) > max(self.queue.maxsize, 1):
+            self._primed.popleft()
+            self.numDrops += 1
                
     def clear(self):
         try:
@@ -154,12 +233,15 @@ class PipelineWorker():
     def start(self): 
         '''Starts the worker thread.
         '''     
-        self.thread = threading.Thread(target=self.__run)
+        self.thread = threading.Thread( \
+            target=self.__run, name=self.stageName())
         self.thread.start()
         
     def get(self):
         '''Gets a output.
         '''
+        if len(self._primed) > 0:
+            return self._primed.popleft()
         if self._error:
             logging.info('VideoAppUtilsEosError')
             raise VideoAppUtilsEosError
@@ -241,18 +323,48 @@ class ContinuousVideoCapture(PipelineWorker):
         # Not work for OpenCV 4.1
         self.width = self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)
         self.height = self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        self.csi = cameraId < 0
+        self.timestamps = FrameTimestamps()
+        self.pool = None
+        self._resolution = None
+        self._frameShape = None
     
     def __del__(self):
         super().__del__()
         self.capture.release()
+
+    def requestResolution(self, width, height):
+        '''Requests to change the capture size at the next frame.
+        
+        Returns:
+            False if the camera does not support the runtime change
+        '''
+        if self.csi:
+            return False
+        self._resolution = (width, height)
+        return True
         
     def getData(self):
-        ret, frame = self.capture.read()
+        resolution = self._resolution
+        if resolution is not None:
+            self._resolution = None
+            self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+            self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+            self.width = self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)
+            self.height = self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
+            logging.info('Capture size: %dx%d' % (self.width, self.height))
+        dst = None
+        if self.pool is not None and self._frameShape is not None:
+            # Decoded into the pooled buffer if the size is not changed
+            dst = self.pool.acquire(self._frameShape)
+        ret, frame = self.capture.read(dst)
         if ret == False:
             raise VideoAppUtilsEosError
+        self._frameShape = frame.shape
         return frame
         
     def process(self, srcData):
+        self.timestamps.stamp(srcData)
         return (True, srcData)
 
 
@@ -299,13 +411,19 @@ class VideoDecoder(PipelineWorker):
         self.width = self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)
         self.height = self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
         self.frames = 0
+        self.timestamps = FrameTimestamps()
+        self.pool = None
+        self._frameShape = None
     
     def __del__(self):
         super().__del__()
         self.capture.release()
         
     def getData(self):
-        ret, frame = self.capture.read()
+        dst = None
+        if self.pool is not None and self._frameShape is not None:
+            dst = self.pool.acquire(self._frameShape)
+        ret, frame = self.capture.read(dst)
         if ret == False:
             if self.repeat:
                 # Reopen the video file
@@ -322,12 +440,475 @@ class VideoDecoder(PipelineWorker):
                 logging.info('End of stream at frame %d' % (self.frames))
                 raise VideoAppUtilsEosError
         self.frames += 1
+        self._frameShape = frame.shape
         return frame
+
+    def requestResolution(self, width, height):
+        return False
+        
+    def process(self, srcData):
+        self.timestamps.stamp(srcData)
+        return (True, srcData)
+
+
+class SharedFrameRing():
+    '''A ring of video frames in shared memory with sequence numbers.
+    A single writer process publishes the frames and any number of reader
+    processes attach to the ring by name.
+    
+    +-------+---------------------------------------+-------------------+
+    | magic | slots, width, height, channels,       | seq pairs per     |
+    | 'VRNG'| latest seq, closed (uint64)           | slot (uint64 x 2) |
+    +-------+---------------------------------------+-------------------+
+    | frame slots (uint8 x slots x height x width x channels)           |
+    +-------------------------------------------------------------------+
+    
+    The writer stores the sequence number to the first of the slot pair
+    before writing the frame, and to the second after. A slot is complete
+    when both are the same.
+    
+    Attributes:
+        name: Shared memory name
+        slots: Number of the frame slots
+        frames: numpy view of the frame slots
+    '''
+
+    MAGIC = b'VRNG'
+    META = 8
+    SEQS = 64
+
+    def __init__(self, name, shape=None, slots=8):
+        '''
+        Args:
+            name(str): Shared memory name
+            shape(tuple): Frame shape (height, width, channels). If
+                specified, a new ring is created, otherwise attached.
+            slots(int): Number of the frame slots of a new ring
+        '''
+        from multiprocessing import shared_memory
+        self.name = name
+        self._owner = shape is not None
+        try:
+            if self._owner:
+                height, width, channels = shape
+                size = self._dataOffset(slots) \
+                    + slots * height * width * channels
+                self.shm = shared_memory.SharedMemory( \
+                    name=name, create=True, size=size)
+            else:
+                self.shm = SharedFrameRing._attach(shared_memory, name)
+        except FileExistsError:
+            raise VideoAppUtilsDeviceError( \
+                'Shared memory %s already exists. ' % (name) \
+                + 'Another capture daemon is running, or remove ' \
+                + '/dev/shm/%s left by a killed one.' % (name))
+        except OSError as e:
+            raise VideoAppUtilsDeviceError( \
+                'Shared memory %s could not be opened: %s' % (name, str(e)))
+        buf = self.shm.buf
+        self._meta = np.ndarray((6,), dtype=np.uint64, \
+            buffer=buf, offset=SharedFrameRing.META)
+        if self._owner:
+            self._meta[:] = (slots, width, height, channels, 0, 0)
+            buf[0:4] = SharedFrameRing.MAGIC
+        elif bytes(buf[0:4]) != SharedFrameRing.MAGIC:
+            raise VideoAppUtilsDeviceError( \
+                'Shared memory %s is not a frame ring' % (name))
+        slots, width, height, channels = [int(v) for v in self._meta[:4]]
+        self.slots = slots
+        self._seqs = np.ndarray((slots, 2), dtype=np.uint64, \
+            buffer=buf, offset=SharedFrameRing.SEQS)
+        self.frames = np.ndarray((slots, height, width, channels), \
+            dtype=np.uint8, buffer=buf, offset=self._dataOffset(slots))
+
+    @staticmethod
+    def _dataOffset(slots):
+        return (SharedFrameRing.SEQS + slots * 16 + 63) // 64 * 64
+
+    @staticmethod
+    def _attach(shared_memory, name):
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 unlinks the attached memory at exit otherwise
+            from multiprocessing import resource_tracker
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
+
+    def shape(self):
+        return self.frames.shape[1:]
+
+    def latest(self):
+        '''Returns the sequence number of the latest frame, 0 if none.
+        '''
+        return int(self._meta[4])
+
+    def closed(self):
+        return int(self._meta[5]) != 0
+
+    def write(self, frame):
+        '''Publishes a frame.
         
+        Returns:
+            Sequence number of the frame
+        '''
+        seq = self.latest() + 1
+        slot = seq % self.slots
+        self._seqs[slot, 0] = seq
+        self.frames[slot] = frame
+        self._seqs[slot, 1] = seq
+        self._meta[4] = seq
+        return seq
+
+    def read(self, seq):
+        '''Returns a read-only view of a frame without copy. The view is
+        valid until the slot is reused by the writer.
+        
+        Returns:
+            The frame view, or None if the frame is not available
+        '''
+        slot = seq % self.slots
+        if int(self._seqs[slot, 1]) != seq or int(self._seqs[slot, 0]) != seq:
+            return None
+        frame = self.frames[slot]
+        frame.flags.writeable = False
+        return frame
+
+    def valid(self, seq):
+        '''Returns True if the frame has not been overwritten yet.
+        '''
+        return int(self._seqs[seq % self.slots, 0]) == seq
+
+    def close(self):
+        '''Detaches the ring. The owner marks it closed and unlinks it.
+        '''
+        if self.shm is None:
+            return
+        if self._owner:
+            self._meta[5] = 1
+        self._meta = None
+        self._seqs = None
+        self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Frame views are still referenced, released at exit
+            pass
+        if self._owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+class SharedMemoryCapture(PipelineWorker):
+    '''Video capture worker thread reading a SharedFrameRing published by
+    the capture daemon. Each frame is copied out of the shared memory, into
+    a pooled buffer if the pool is set, and the copy is validated against
+    the writer lapping the ring. If no new frame is published within the
+    timeout, the daemon is regarded as dead and the end of stream is raised.
+    '''
+
+    def __init__(self, name, qsize=30, pollInterval=0.001, timeout=5.0):
+        '''
+            Args:
+                name(str): Shared memory name
+                qsize(int): Capture queue capacity
+                pollInterval(float): Polling interval for new frames
+                timeout(float): Maximum time in second without a new frame.
+                    If None, waits forever.
+        '''
+        super().__init__(qsize)
+        self.ring = SharedFrameRing(name)
+        self.height, self.width = self.ring.shape()[:2]
+        self.pollInterval = pollInterval
+        self.timeout = timeout
+        self.timestamps = FrameTimestamps()
+        self.lastSeq = self.ring.latest()
+        self.numSkips = 0
+        self.pool = None
+
+    def __del__(self):
+        super().__del__()
+        self.ring.close()
+
+    def requestResolution(self, width, height):
+        return False
+
+    def getData(self):
+        while True:
+            frame = self._read()
+            if frame is not None:
+                return frame
+
+    def _read(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            if self.ring.closed():
+                raise VideoAppUtilsEosError
+            latest = self.ring.latest()
+            if latest > self.lastSeq:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.warning('No frame from %s in %.1f seconds' \
+                    % (self.ring.name, self.timeout))
+                raise VideoAppUtilsEosError
+            time.sleep(self.pollInterval)
+        seq = self.lastSeq + 1
+        if latest - seq >= self.ring.slots - 1:
+            # Too slow, skip to the latest frame
+            self.numSkips += latest - seq
+            seq = latest
+        frame = self.ring.read(seq)
+        if frame is None:
+            seq = latest
+            frame = self.ring.read(seq)
+            if frame is None:
+                # Being overwritten, retried
+                return None
+        self.lastSeq = seq
+        if self.pool is not None:
+            copy = self.pool.acquire(frame.shape)
+            np.copyto(copy, frame)
+        else:
+            copy = frame.copy()
+        if not self.ring.valid(seq):
+            # Torn by the writer lapping the ring while copying
+            self.numSkips += 1
+            return None
+        return copy
+
     def process(self, srcData):
+        self.timestamps.stamp(srcData)
         return (True, srcData)
 
 
+class ParallelPipelineWorker(PipelineWorker):
+    '''A pipeline stage executed by multiple parallel replicas.
+    Inputs from the source are numbered in arrival order and dispatched to
+    the replicas. The replica outputs are reassembled in the input order by
+    a reorder buffer, so the downstream stages see the same sequence as with
+    a single worker.
+
+                         +-> Replica#1 --+
+    source.get()->(seq)--+-> Replica#2 --+->(reorder buffer)->(Q)->
+                         +-> Replica#N --+
+
+    Attributes:
+        replicas: List of the replica PipelineWorker objects. Their threads
+            are not started, only the process method is called.
+        policy: Dispatch policy, 'roundrobin' or 'leastloaded'
+        window: Maximum number of the inputs in flight. The reorder buffer
+            never holds more than this number of outputs.
+    '''
+
+    POLICIES = ('roundrobin', 'leastloaded')
+
+    fusible = False
+
+    _EOS = object()
+
+    def __init__(self, qsize, source, factory, numReplicas=2, \
+        policy='roundrobin', window=None, drop=True):
+        '''
+        Args:
+            qsize(int): Output queue capacity
+            source(PipelineWorker): Data source
+            factory(callable): Called as factory(qsize, None) to create
+                a replica PipelineWorker object
+            numReplicas(int): Number of the replicas
+            policy(str): Dispatch policy, 'roundrobin' or 'leastloaded'
+            window(int): Reordering window. If ommited, twice the number of
+                the replicas.
+        '''
+        super().__init__(qsize, source, drop)
+        if numReplicas < 1:
+            raise VideoAppUtilsError( \
+                'Invalid number of replicas: %d' % (numReplicas))
+        if policy not in ParallelPipelineWorker.POLICIES:
+            raise VideoAppUtilsError('Invalid dispatch policy: %s' % (policy))
+        self.replicas = [factory(qsize, None) for i in range(numReplicas)]
+        self.policy = policy
+        if window is None:
+            window = 2 * numReplicas
+        self.window = max(window, numReplicas)
+        self._inQueues = [queue.Queue() for r in self.replicas]
+        self._load = [0] * numReplicas
+        self._busy = [0.0] * numReplicas
+        self._inflight = threading.Semaphore(self.window)
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._nextSeq = 0
+        self._eos = False
+        self._running = threading.Event()
+        self._threads = []
+        self._startTime = None
+        self._rrIndex = 0
+
+    def __repr__(self):
+        util = ' '.join( \
+            ['%3d%%' % (u * 100) for u in self.replicaUtilization()])
+        return '%s [%s]' % (super().__repr__(), util)
+
+    def replicaUtilization(self):
+        '''Returns the busy time ratio of each replica since the start.
+        '''
+        if self._startTime is None:
+            return [0.0] * len(self.replicas)
+        elapsed = max(time.time() - self._startTime, 1e-6)
+        return [min(busy / elapsed, 1.0) for busy in self._busy]
+
+    def _selectReplica(self):
+        if self.policy == 'leastloaded':
+            return self._load.index(min(self._load))
+        index = self._rrIndex
+        self._rrIndex = (self._rrIndex + 1) % len(self.replicas)
+        return index
+
+    def stageName(self):
+        return self.replicas[0].stageName()
+
+    def _dispatch(self):
+        self.bindThread()
+        seq = 0
+        while self._running.is_set():
+            if not self._inflight.acquire(timeout=0.1):
+                continue
+            try:
+                src = super().getData()
+            except VideoAppUtilsEosError:
+                with self._cond:
+                    self._pending[seq] = ParallelPipelineWorker._EOS
+                    self._cond.notify_all()
+                break
+            index = self._selectReplica()
+            with self._cond:
+                self._load[index] += 1
+            self._inQueues[index].put((seq, src))
+            seq += 1
+
+    def _work(self, index):
+        replica = self.replicas[index]
+        inQueue = self._inQueues[index]
+        self.bindThread()
+        logging.info('%s replica#%d thread started' \
+            % (replica.__class__.__name__, index))
+        while self._running.is_set():
+            try:
+                seq, src = inQueue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            startTime = time.time()
+            try:
+                result = replica.process(src)
+            except Exception as e:
+                logging.critical(e)
+                result = (False, None)
+            self._busy[index] += time.time() - startTime
+            with self._cond:
+                self._load[index] -= 1
+                self._pending[seq] = result
+                self._cond.notify_all()
+        logging.info('%s replica#%d thread terminated' \
+            % (replica.__class__.__name__, index))
+
+    def getData(self):
+        if self._eos:
+            raise VideoAppUtilsEosError
+        with self._cond:
+            while self._nextSeq not in self._pending:
+                if not self._running.is_set():
+                    return None
+                self._cond.wait(timeout=0.1)
+            result = self._pending.pop(self._nextSeq)
+            self._nextSeq += 1
+        self._inflight.release()
+        if result is ParallelPipelineWorker._EOS:
+            self._eos = True
+            raise VideoAppUtilsEosError
+        return result
+
+    def process(self, srcData):
+        if srcData is None:
+            return (True, None)
+        ret, dat = srcData
+        if ret:
+            # Reordered, all replicas are of the same class
+            dat = self.replicas[0].complete(dat)
+        return (ret, dat)
+
+    def start(self):
+        '''Starts the dispatcher, the replica and the worker threads.
+        '''
+        self._running.set()
+        self._startTime = time.time()
+        name = self.stageName()
+        self._threads = [threading.Thread( \
+            target=self._dispatch, name='%s.dispatch' % (name))]
+        for index in range(len(self.replicas)):
+            self._threads.append(threading.Thread(target=self._work, \
+                args=(index,), name='%s#%d' % (name, index)))
+        for thread in self._threads:
+            thread.start()
+        super().start()
+
+    def stop(self):
+        '''Stops all threads of this stage.
+        '''
+        self._running.clear()
+        super().stop()
+        for thread in self._threads:
+            thread.join()
+
+
+class FusedPipelineWorker(PipelineWorker):
+    '''Adjacent pipeline stages executed in a single thread.
+    The process methods of the member stages are called in order, which
+    eliminates the queue hand-offs and the context switches between them.
+    The members keep their own service time metrics.
+
+    source.get()->[Member#1.process()->...->Member#N.process()]->(Q)->
+
+    Attributes:
+        members: List of the member PipelineWorker objects from upstream.
+            Their threads are not started.
+    '''
+
+    def __init__(self, members):
+        '''
+        Args:
+            members(list): Connected PipelineWorker objects from upstream.
+                The fused worker replaces them in the chain.
+        '''
+        first, last = members[0], members[-1]
+        super().__init__(last.queue.maxsize, first.source, last.drop)
+        self.members = list(members)
+        self.destination = last.destination
+        if self.destination is not None:
+            self.destination.source = self
+        for member in self.members:
+            if member.cpus is not None:
+                self.cpus = member.cpus
+                break
+
+    def __repr__(self):
+        times = ' + '.join(['%s %.2fms' % (m.stageName(), \
+            m.serviceTime * 1000) for m in self.members])
+        return '%s (%s)' % (super().__repr__(), times)
+
+    def stageName(self):
+        return '+'.join([m.stageName() for m in self.members])
+
+    def process(self, srcData):
+        dat = srcData
+        for member in self.members:
+            ret, dat = member.timedProcess(dat)
+            if ret is None or ret == False:
+                return (ret, None)
+        return (True, dat)
+
+
 class IntervalCounter():
     '''A counter to measure the interval between the measure method calls.
     
@@ -365,18 +946,545 @@ class IntervalCounter():
         self.samples = np.append(self.samples, elapsedTime)
         self.samples = np.delete(self.samples, 0)
         self.count += 1
+        return self.average()
+
+    def average(self):
+        '''Returns the average interval of the last numSamples intervals,
+        or None if not enough intervals measured.
+        '''
         if self.count > self.numSamples:
             return np.average(self.samples)
         else:
             return None
 
 
+class FrameTimestamps():
+    '''Capture time stamps of the frames flowing through the pipeline.
+    A frame is identified by its object identity, so that the stages do not
+    need to carry the time stamp along with the frame.
+    
+    Attributes:
+        maxFrames: Maximum number of the frames tracked. The oldest time
+            stamps, usually of the dropped frames, are discarded.
+    '''
+
+    def __init__(self, maxFrames=256):
+        self.maxFrames = maxFrames
+        self._stamps = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def stamp(self, frame):
+        '''Records the current time as the capture time of the frame.
+        '''
+        with self._lock:
+            self._stamps[id(frame)] = time.time()
+            while len(self._stamps) > self.maxFrames:
+                self._stamps.popitem(last=False)
+
+    def pop(self, frame):
+        '''Returns the capture time of the frame and forgets it.
+        
+        Returns:
+            Capture time or None if the frame is unknown
+        '''
+        with self._lock:
+            return self._stamps.pop(id(frame), None)
+
+
+class _FrameLease():
+    '''Array interface of a pooled buffer. The arrays created from a lease
+    and all views derived from them keep the lease alive.
+    '''
+
+    def __init__(self, buffer):
+        self.__array_interface__ = buffer.__array_interface__
+        self.buffer = buffer
+
+
+class FramePool():
+    '''A bounded pool of preallocated frame buffers.
+    The acquire method returns a numpy array backed by a pooled buffer,
+    which can be passed to the OpenCV functions as the dst argument. The
+    buffers are reference counted by Python: a buffer returns to the pool
+    when the last consumer releases the array and all views derived from
+    it, so the stages need no explicit release.
+
+    Attributes:
+        maxBuffers: Maximum number of the buffers of each shape and type
+        numAllocs: Total number of the allocated buffers
+        numReuses: Total number of the reused buffers
+        numMisses: Total number of the unpooled arrays returned because all
+            buffers of the shape were in use
+    '''
+
+    def __init__(self, maxBuffers=16):
+        '''
+        Args:
+            maxBuffers(int): Maximum number of the buffers of each shape
+                and type
+        '''
+        self.maxBuffers = maxBuffers
+        self.numAllocs = 0
+        self.numReuses = 0
+        self.numMisses = 0
+        self._free = {}
+        self._counts = {}
+        # Reentrant, a buffer can be released by the garbage collector
+        # while acquiring
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return 'pool %d buffers, %d reuses, %d misses' \
+            % (self.numAllocs, self.numReuses, self.numMisses)
+
+    def reserve(self, shape, dtype=np.uint8, count=None):
+        '''Preallocates the buffers of a shape.
+
+        Args:
+            shape(tuple): Array shape
+            dtype: Array data type
+            count(int): Number of the buffers. If ommited, maxBuffers.
+        '''
+        key = (tuple(shape), np.dtype(dtype).str)
+        if count is None:
+            count = self.maxBuffers
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            while self._counts.get(key, 0) < min(count, self.maxBuffers):
+                free.append(np.empty(shape, dtype))
+                self._counts[key] = self._counts.get(key, 0) + 1
+                self.numAllocs += 1
+
+    def acquire(self, shape, dtype=np.uint8):
+        '''Returns an array backed by a pooled buffer. The contents are
+        undefined. If all buffers of the shape are in use, a new unpooled
+        array is returned.
+        '''
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if len(free) > 0:
+                buffer = free.pop()
+                self.numReuses += 1
+            elif self._counts.get(key, 0) < self.maxBuffers:
+                buffer = np.empty(shape, dtype)
+                self._counts[key] = self._counts.get(key, 0) + 1
+                self.numAllocs += 1
+            else:
+                self.numMisses += 1
+                return np.empty(shape, dtype)
+        lease = _FrameLease(buffer)
+        weakref.finalize(lease, self._release, key, buffer).atexit = False
+        return np.asarray(lease)
+
+    def _release(self, key, buffer):
+        with self._lock:
+            self._free[key].append(buffer)
+
+
+class QualityKnob():
+    '''A runtime quality setting adjusted by AdaptiveQualityController.
+    Sub classes should implement the degrade and restore methods.
+    
+    Attributes:
+        name: Knob name for the log messages
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def degrade(self):
+        '''Lowers the quality by one step.
+        
+        Returns:
+            False if the quality can not be lowered any more
+        '''
+        return False
+
+    def restore(self):
+        '''Raises the quality by one step.
+        
+        Returns:
+            False if the quality is already at the highest
+        '''
+        return False
+
+    def describe(self):
+        '''Returns the current setting as a string.
+        '''
+        return ''
+
+
+class AdaptiveQualityController():
+    '''Adjusts the quality knobs to meet the frame rate and latency targets.
+    The controller thread periodically evaluates the output frame rate,
+    the end-to-end latency, the pipeline queue occupancy and the frame drop
+    rate. If the pipeline is overloaded, the first knob which can be
+    degraded is degraded by one step. If the pipeline has enough headroom
+    for several periods, the last degraded knob is restored by one step.
+    
+    Attributes:
+        knobs(list): QualityKnob objects in the order to be degraded
+        targetFps(float): Target output frame rate, or None
+        targetLatency(float): Target end-to-end latency in second, or None
+        interval(float): Evaluation period in second
+        highWater(float): Queue occupancy regarded as overloaded
+        lowWater(float): Queue occupancy regarded as headroom
+        maxDropRate(float): Dropped frames per second regarded as
+            overloaded, or None to ignore the drops
+        patience(int): Number of periods with headroom before restoring
+    '''
+
+    def __init__(self, vproc, knobs, targetFps=None, targetLatency=None, \
+        interval=1.0, highWater=0.75, lowWater=0.25, maxDropRate=None, \
+        patience=3):
+        '''
+        Args:
+            vproc(ContinuousVideoProcess): Video process to be controlled
+        '''
+        self.vproc = vproc
+        self.knobs = knobs
+        self.targetFps = targetFps
+        self.targetLatency = targetLatency
+        self.interval = interval
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.maxDropRate = maxDropRate
+        self.patience = patience
+        self._degraded = []
+        self._calm = 0
+        self._event = threading.Event()
+        self.thread = None
+
+    def measure(self):
+        '''Returns the current metrics of the pipeline.
+        
+        Returns:
+            (fps, latency, occupancy, drops) tuple. fps is the output frame
+            rate, None until enough frames are output to measure it. drops
+            is the total number of the dropped frames.
+        '''
+        vproc = self.vproc
+        interval = vproc.fpsCounter.average()
+        fps = 1.0 / interval if interval else None
+        latencies = list(vproc.latencies)
+        latency = float(np.percentile(latencies, 90)) if latencies else 0.0
+        capacity = 0
+        queued = 0
+        drops = 0
+        for worker in vproc.pipeline:
+            capacity += max(worker.queue.maxsize, 1)
+            queued += worker.qsize()
+            drops += worker.numDrops
+        return (fps, latency, queued / capacity, drops)
+
+    def evaluate(self, fps, latency, occupancy, dropRate):
+        '''Classifies the load of the pipeline.
+        
+        Returns:
+            (load, reason) tuple, load is 1 if overloaded, -1 if there is
+            headroom, otherwise 0.
+        '''
+        if self.targetFps is not None and fps < self.targetFps * 0.95:
+            return (1, 'fps %.1f < %.1f' % (fps, self.targetFps))
+        if self.targetLatency is not None and latency > self.targetLatency:
+            return (1, 'latency %.0fms > %.0fms' \
+                % (latency * 1000, self.targetLatency * 1000))
+        if occupancy > self.highWater:
+            return (1, 'queue occupancy %.2f' % (occupancy))
+        if self.maxDropRate is not None and dropRate > self.maxDropRate:
+            return (1, 'drop rate %.1f/s' % (dropRate))
+        if self.targetFps is not None and fps < self.targetFps * 1.1:
+            return (0, None)
+        if self.targetLatency is not None \
+            and latency > self.targetLatency * 0.7:
+            return (0, None)
+        if occupancy > self.lowWater:
+            return (0, None)
+        return (-1, 'fps %.1f, latency %.0fms, queue occupancy %.2f' \
+            % (fps, latency * 1000, occupancy))
+
+    def step(self, load, reason):
+        '''Adjusts the knobs by one step according to the load.
+        '''
+        if load > 0:
+            self._calm = 0
+            for knob in self.knobs:
+                if knob.degrade():
+                    if knob not in self._degraded:
+                        self._degraded.append(knob)
+                    logging.warning('Quality lowered: %s -> %s (%s)' \
+                        % (knob.name, knob.describe(), reason))
+                    return
+            logging.debug('No quality knob to lower (%s)' % (reason))
+        elif load < 0 and len(self._degraded) > 0:
+            self._calm += 1
+            if self._calm < self.patience:
+                return
+            self._calm = 0
+            knob = self._degraded[-1]
+            if not knob.restore():
+                self._degraded.pop()
+                return
+            logging.warning('Quality raised: %s -> %s (%s)' \
+                % (knob.name, knob.describe(), reason))
+        else:
+            self._calm = 0
+
+    def _run(self):
+        lastDrops = None
+        lastTime = time.time()
+        while not self._event.wait(self.interval):
+            fps, latency, occupancy, drops = self.measure()
+            if fps is None:
+                # Not evaluated during the start-up
+                continue
+            curTime = time.time()
+            if lastDrops is None:
+                dropRate = 0.0
+            else:
+                dropRate = (drops - lastDrops) / (curTime - lastTime)
+            lastDrops = drops
+            lastTime = curTime
+            load, reason = self.evaluate(fps, latency, occupancy, dropRate)
+            self.step(load, reason)
+
+    def start(self):
+        '''Starts the controller thread.
+        '''
+        self._event.clear()
+        self.thread = threading.Thread( \
+            target=self._run, name='QualityController', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stops the controller thread.
+        '''
+        self._event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class PipelineProfiler():
+    '''A low overhead sampling profiler for the pipeline threads.
+    The CPU time of each thread is read from its thread CPU clock and
+    compared with the wall time. The stacks of the threads are sampled
+    periodically and counted in the collapsed stack format, which can be
+    rendered by flamegraph.pl or speedscope. A thread which is active in
+    the samples but uses less CPU time is likely waiting for the GIL or
+    blocked in native code.
+    
+    Attributes:
+        outDir(str): Directory to write the profile files
+        interval(float): Sampling interval in second
+    '''
+
+    # Top frames regarded as idle, waiting for the other stages
+    IDLE_FUNCS = frozenset(['wait', 'get', 'acquire', 'sleep', 'select', \
+        'accept', 'recv', 'recv_into', '_wait_for_tstate_lock'])
+
+    def __init__(self, outDir, interval=0.05):
+        self.outDir = outDir
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self.thread = None
+        self._reset()
+
+    def _reset(self):
+        self._stacks = collections.Counter()
+        self._active = collections.Counter()
+        self._samples = collections.Counter()
+        self._startTime = time.time()
+        self._startCpu = self.cpuTimes()
+        self._lastCpu = dict(self._startCpu)
+
+    @staticmethod
+    def cpuTimes():
+        '''Returns the CPU time in second of each living thread by name.
+        '''
+        times = {}
+        if not hasattr(time, 'pthread_getcpuclockid'):
+            return times
+        for thread in threading.enumerate():
+            try:
+                clock = time.pthread_getcpuclockid(thread.ident)
+                times[thread.name] = time.clock_gettime(clock)
+            except (OSError, TypeError):
+                pass
+        return times
+
+    def sample(self):
+        '''Samples the stacks of all threads except the profiler.
+        '''
+        frames = sys._current_frames()
+        names = dict([(t.ident, t.name) for t in threading.enumerate()])
+        cpu = self.cpuTimes()
+        with self._lock:
+            # Keep the CPU time of the threads which may terminate
+            self._lastCpu.update(cpu)
+            for ident, frame in frames.items():
+                if ident == threading.get_ident() or ident not in names:
+                    continue
+                name = names[ident]
+                top = frame.f_code.co_name
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, \
+                        code.co_filename.split('/')[-1], frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(name)
+                self._stacks[';'.join(stack[::-1])] += 1
+                self._samples[name] += 1
+                if top not in PipelineProfiler.IDLE_FUNCS:
+                    self._active[name] += 1
+
+    def report(self):
+        '''Returns the per thread CPU and activity report since the last
+        dump as a list of lines.
+        '''
+        with self._lock:
+            wall = max(time.time() - self._startTime, 1e-6)
+            cpu = self._lastCpu
+            cpu.update(self.cpuTimes())
+            lines = ['%-24s %6s %6s %8s' \
+                % ('thread', 'cpu%', 'active', 'samples')]
+            for name in sorted(self._samples.keys()):
+                used = cpu.get(name, 0.0) - self._startCpu.get(name, 0.0)
+                lines.append('%-24s %5.1f%% %5.1f%% %8d' % (name, \
+                    100.0 * used / wall, \
+                    100.0 * self._active[name] / self._samples[name], \
+                    self._samples[name]))
+        return lines
+
+    def dump(self):
+        '''Writes the collapsed stacks and the CPU report, then restarts
+        the accounting.
+        
+        Returns:
+            Path of the collapsed stack file
+        '''
+        if not os.path.exists(self.outDir):
+            os.makedirs(self.outDir)
+        base = os.path.join(self.outDir, \
+            'profile-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        lines = self.report()
+        with self._lock:
+            stacks = self._stacks
+            self._reset()
+        with open(base + '.collapsed', 'w') as f:
+            for stack, count in stacks.items():
+                f.write('%s %d\n' % (stack, count))
+        with open(base + '.txt', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        for line in lines:
+            logging.warning(line)
+        logging.warning('Profile written to %s.collapsed' % (base))
+        return base + '.collapsed'
+
+    def _run(self):
+        while not self._event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        '''Starts the sampling thread.
+        '''
+        self._event.clear()
+        with self._lock:
+            self._reset()
+        self.thread = threading.Thread( \
+            target=self._run, name='PipelineProfiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stops the sampling thread.
+        '''
+        self._event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def parseCpuList(spec):
+    '''Parses a CPU list like '0-2,4'.
+
+    Returns:
+        Set of the CPU numbers
+    '''
+    cpus = set()
+    for item in spec.split(','):
+        first, sep, last = item.partition('-')
+        try:
+            if sep:
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(first))
+        except ValueError:
+            raise VideoAppUtilsError('Invalid CPU list: %s' % (spec))
+    return cpus
+
+
+def parseAffinity(spec):
+    '''Parses a stage affinity specification like 'Inference=1;Display=0'.
+
+    Returns:
+        Dict of the CPU sets by stage name
+    '''
+    affinity = {}
+    if spec is None:
+        return affinity
+    for item in spec.split(';'):
+        name, sep, cpus = item.partition('=')
+        if not sep:
+            raise VideoAppUtilsError('Invalid affinity: %s' % (item))
+        affinity[name.strip()] = parseCpuList(cpus)
+    return affinity
+
+
+def bindCurrentThread(name, cpus):
+    '''Binds the calling thread to a CPU set. A failure is logged as
+    a warning.
+
+    Args:
+        name(str): Stage name for the log message
+        cpus(set): CPU set. If None, the thread is not bound.
+    '''
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            logging.warning('%s: could not set CPU affinity %s: %s' \
+                % (name, str(sorted(cpus)), str(e)))
+
+
+def autoNumThreads(numCpus=None):
+    '''Returns the default size of the library thread pools.
+    The pipeline stages already run in parallel, so the library pools are
+    kept small on the small CPUs to avoid the oversubscription.
+    '''
+    if numCpus is None:
+        numCpus = os.cpu_count() or 1
+    if numCpus <= 4:
+        return 1
+    return numCpus // 2
+
+
 class ContinuousVideoProcess():
     '''Captured video processing applicaion framework
     
     Attributes:
         capture(ContinuousVideoCapture): Video capture process
         fpsCounter(IntervalCounter): FPS counter
+        latencies(collections.deque): Recent end-to-end latencies in second
+        controller(AdaptiveQualityController): Quality controller, or None
+        profiler(PipelineProfiler): Profiler, or None
+        affinity(dict): CPU sets by stage name, 'Display' for the main thread
+        fuse(float): Maximum service time of a fused stage in second.
+            If None, the stages are not fused.
+        warmup(int): Number of the frames to measure the service times
+        framePool(FramePool): Frame buffer pool, or None
         qinfo(bool): If set, print processing queue status
         title(str): Window title
         pipeline(list): List of the pipeline worker objects
@@ -387,7 +1495,9 @@ class ContinuousVideoProcess():
         Args:
             args(argparse.Namespace): video capture command-line arguments
         '''
-        if args.src_file is not None:
+        if args.shm is not None:
+            self.capture = SharedMemoryCapture(args.shm, args.qsize)
+        elif args.src_file is not None:
             self.capture = VideoDecoder( \
                 args.src_file, args.qsize, args.repeat, args.h265)
         else:
@@ -404,12 +1514,52 @@ class ContinuousVideoProcess():
         self.qinfo = args.qinfo
         self.title = args.title
         self.nodrop = args.nodrop
+        self.dispatch = args.dispatch
+        self.latencies = collections.deque(maxlen=100)
+        self.controller = None
+        self.affinity = parseAffinity(args.affinity)
+        self.cvThreads = args.cv_threads
+        if self.cvThreads < 0:
+            self.cvThreads = autoNumThreads()
+        cv2.setNumThreads(self.cvThreads)
+        self.profiler = None
+        if args.profile is not None:
+            self.profiler = PipelineProfiler(args.profile)
+        self.fuse = None
+        if args.fuse is not None:
+            self.fuse = args.fuse / 1000
+        self.warmup = args.warmup
+        self.framePool = None
+        if args.pool > 0:
+            self.framePool = FramePool(args.pool)
+            self.capture.pool = self.framePool
         self.pipeline = None
         
     def __del__(self):
         cv2.destroyAllWindows()
         self.stopPipeline()
 
+    def createStage(self, workerClass, qsize, source, replicas, *args):
+        '''Creates a pipeline stage, optionally with parallel replicas.
+
+        Args:
+            workerClass(class): PipelineWorker sub class, its constructor
+                should take (qsize, source, *args).
+            qsize(int): Output queue capacity
+            source(PipelineWorker): Data source
+            replicas(int): Number of the replicas. If 1 or less,
+                a single worker is created.
+
+        Returns:
+            The stage object
+        '''
+        if replicas <= 1:
+            return workerClass(qsize, source, *args)
+        logging.info('%s: %d replicas (%s)' \
+            % (workerClass.__name__, replicas, self.dispatch))
+        return ParallelPipelineWorker(qsize, source, \
+            lambda q, s: workerClass(q, s, *args), replicas, self.dispatch)
+
     def scanPipeline(self):
         pipeline = []
         self.__class__.getSources(self.capture, pipeline)
@@ -420,21 +1570,157 @@ class ContinuousVideoProcess():
         for worker in self.pipeline:
             if self.nodrop:
                 worker.drop = False
-            worker.start()
+            worker.cpus = self.affinity.get(worker.stageName())
+        names = set([worker.stageName() for worker in self.pipeline])
+        for name in sorted(set(self.affinity) - names - set(['Display'])):
+            logging.warning('No pipeline stage for the affinity: %s' % (name))
+        if self.fuse is not None:
+            # The capture thread feeds the warm-up frames
+            self.capture.start()
+            self.fuseStages(self.fuse, self.warmup)
+        for worker in self.pipeline:
+            if worker is not self.capture or self.fuse is None:
+                worker.start()
+        if self.controller is not None:
+            self.controller.start()
+        if self.profiler is not None:
+            self.profiler.start()
+        # Bound after starting the other threads not to be inherited
+        bindCurrentThread('Display', self.affinity.get('Display'))
+
+    def fuseStages(self, threshold, numFrames):
+        '''Measures the service times of the stages with warm-up frames and
+        fuses the adjacent cheap stages into single threads.
+        The warm-up frames are processed sequentially in the calling thread
+        and the outputs are queued to the last stage reached, so no frame is
+        lost. The capture thread should be running and the other worker
+        threads should not be started.
+
+        Args:
+            threshold(float): Maximum total service time of a fused stage
+                in second
+            numFrames(int): Number of the warm-up frames
+        '''
+        # Only the stages with synchronous outputs can be run sequentially
+        chain = []
+        for worker in self.pipeline[-2::-1]:
+            if not worker.fusible:
+                break
+            chain.append(worker)
+        if len(chain) < 2:
+            return
+        samples = [[] for worker in chain]
+        outputs = []
+        failed = None
+        for count in range(numFrames):
+            try:
+                dat = self.capture.get()
+            except VideoAppUtilsEosError:
+                break
+            for index, worker in enumerate(chain):
+                startTime = time.perf_counter()
+                try:
+                    ret, dat = worker.timedProcess(dat)
+                except Exception as e:
+                    logging.critical(e)
+                    ret = False
+                samples[index].append(time.perf_counter() - startTime)
+                if ret is None or ret == False:
+                    break
+            else:
+                outputs.append(dat)
+            if ret == False:
+                logging.info('Processing error')
+                failed = worker
+                break
+        # The first call often includes lazy initializations
+        times = [float(np.median(s[1:] if len(s) > 1 else s)) \
+            if len(s) > 0 else None for s in samples]
+        fused = {}
+        group = []
+        total = 0.0
+        for worker, t in list(zip(chain, times)) + [(None, None)]:
+            if t is not None and total + t <= threshold:
+                group.append(worker)
+                total += t
+                continue
+            if len(group) > 1:
+                fusedWorker = FusedPipelineWorker(group)
+                for member in group:
+                    fused[member] = fusedWorker
+            group = []
+            total = 0.0
+            if t is not None and t <= threshold:
+                group = [worker]
+                total = t
+        fused.get(chain[-1], chain[-1]).prime(outputs)
+        if failed is not None:
+            # Reported by the thread which replaced the failed stage
+            fused.get(failed, failed)._error = True
+        self.scanPipeline()
+        measured = dict(zip(chain, times))
+        def describe(worker):
+            t = measured.get(worker)
+            if t is None:
+                return worker.stageName()
+            return '%s %.2fms' % (worker.stageName(), t * 1000)
+        layout = []
+        for worker in self.pipeline[::-1]:
+            if isinstance(worker, FusedPipelineWorker):
+                layout.append('[%s]' \
+                    % (' + '.join([describe(m) for m in worker.members])))
+            else:
+                layout.append(describe(worker))
+        logging.warning('Stage layout: %s' % (' -> '.join(layout)))
 
     def stopPipeline(self):
+        if getattr(self, 'controller', None) is not None:
+            self.controller.stop()
+        if getattr(self, 'profiler', None) is not None \
+            and self.profiler.thread is not None:
+            self.profiler.stop()
+            self.profiler.dump()
         if hasattr(self, 'pipeline') and self.pipeline is not None:
             for worker in self.pipeline:
                 worker.stop()
+        if getattr(self, 'framePool', None) is not None:
+            logging.info('Frame buffer %s' % (repr(self.framePool)))
+
+    def threadLayout(self):
+        '''Returns the effective thread layout as a list of lines.
+        '''
+        lines = ['CPUs: %d, OpenCV threads: %d' \
+            % (os.cpu_count() or 1, cv2.getNumThreads())]
+        for thread in threading.enumerate():
+            cpus = '-'
+            if hasattr(os, 'sched_getaffinity') \
+                and thread.native_id is not None:
+                try:
+                    cpus = ','.join( \
+                        [str(c) for c in sorted( \
+                        os.sched_getaffinity(thread.native_id))])
+                except OSError:
+                    pass
+            lines.append('%-24s tid %-8s cpus %s' \
+                % (thread.name, str(thread.native_id), cpus))
+        return lines
 
     def execute(self):
         ''' execute video processing loop
         '''
         self.startPipeline()
+        layout = False
         while True:
             frame = self.getOutput()
             if frame is None:
                 break
+            if not layout:
+                # All threads are running and bound at the first output
+                layout = True
+                for line in self.threadLayout():
+                    logging.info(line)
+                    if self.qinfo:
+                        print(line)
             if self.qinfo:
                 print(self.pipeline)
             interval = self.fpsCounter.measure()
@@ -466,6 +1752,10 @@ class ContinuousVideoProcess():
         except VideoAppUtilsEosError:
             return None
         else:
+            if frame is not None:
+                stamp = self.capture.timestamps.pop(frame)
+                if stamp is not None:
+                    self.latencies.append(time.time() - stamp)
             return frame
 
     @staticmethod
@@ -518,6 +1808,50 @@ class ContinuousVideoProcess():
         parser.add_argument('--nodrop', \
             action='store_true', \
             help='If set, disable frame drop feature')
+        parser.add_argument('--dispatch', \
+            type=str, \
+            default='roundrobin', \
+            choices=ParallelPipelineWorker.POLICIES, \
+            help='Dispatch policy for the replicated pipeline stages')
+        parser.add_argument('--shm', \
+            type=str, \
+            default=None, \
+            metavar='SHM_NAME', \
+            help='Read frames from the shared memory of the capture daemon')
+        parser.add_argument('--affinity', \
+            type=str, \
+            default=None, \
+            metavar='STAGE=CPUS[;...]', \
+            help='CPU affinity of the pipeline stages, e.g. \
+                "Inference=1;Postprocess=2-3;Display=0"')
+        parser.add_argument('--cv-threads', \
+            type=int, \
+            default=-1, \
+            metavar='NUM', \
+            help='OpenCV thread pool size, negative for automatic')
+        parser.add_argument('--profile', \
+            type=str, \
+            default=None, \
+            metavar='PROFILE_DIR', \
+            help='If set, profile the pipeline threads and write the results \
+                to the directory on SIGUSR2 and at exit')
+        parser.add_argument('--fuse', \
+            type=float, \
+            default=None, \
+            metavar='MSEC', \
+            help='If set, fuse the adjacent stages into a thread while their \
+                total service time measured at warm-up is within MSEC')
+        parser.add_argument('--warmup', \
+            type=int, \
+            default=20, \
+            metavar='FRAMES', \
+            help='Number of the warm-up frames to measure the service times')
+        parser.add_argument('--pool', \
+            type=int, \
+            default=0, \
+            metavar='BUFFERS', \
+            help='If set, reuse up to BUFFERS preallocated frame buffers of \
+                each size across the pipeline stages')
         parser.add_argument('--repeat', \
             action='store_true', \
             help='If set, repeat video decoding')
@@ -544,3 +1878,51 @@ def player():
     vproc = ContinuousVideoProcess(args)
     vproc.execute()
 
+
+def captureDaemon():
+    '''Captures a camera and publishes the frames to a SharedFrameRing.
+    '''
+    cvpParser = ContinuousVideoProcess.argumentParser(title='CaptureDaemon')
+    parser = argparse.ArgumentParser( \
+        parents=[cvpParser], description='Shared Memory Capture Daemon')
+    parser.add_argument('--name', \
+        type=str, \
+        default='video0', \
+        metavar='SHM_NAME', \
+        help='Shared memory name')
+    parser.add_argument('--slots', \
+        type=int, \
+        default=8, \
+        metavar='SLOTS', \
+        help='Number of the frame slots in the shared memory')
+    args = parser.parse_args()
+    args.shm = None
+    vproc = ContinuousVideoProcess(args)
+    capture = vproc.capture
+    # Stopped by a service manager, the ring is closed as on Ctrl-C
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    capture.start()
+    ring = None
+    try:
+        while True:
+            try:
+                frame = capture.get()
+            except VideoAppUtilsEosError:
+                break
+            if frame is None:
+                break
+            if ring is None:
+                ring = SharedFrameRing(args.name, frame.shape, args.slots)
+                logging.info('Publishing %s frames to %s' \
+                    % (str(frame.shape), args.name))
+            ring.write(frame)
+            if args.qinfo:
+                print(capture)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture.stop()
+        if ring is not None:
+            ring.close()